@@ -1,5 +1,5 @@
 from collections import defaultdict
-from factor import multiply
+from factor import multiply_marginalize
 
 
 class BayesianNetwork:
@@ -8,8 +8,11 @@ class BayesianNetwork:
         self._factors = factors
         self._variables = set()
         for factor in self._factors:
-            self._variables = self._variables | set(factor.get_variables())
+            self._variables.update(factor.get_variables())
         self._vars_by_name = {v.get_name(): v for v in self._variables}
+        # QueryEngines by heuristic, filled in by elimination.query_engine. They
+        # live on the network so they are freed along with it.
+        self._query_engines = dict()
 
     def get_variables(self):
         return self._variables
@@ -17,6 +20,10 @@ class BayesianNetwork:
     def get_variable_by_name(self, var_name):
         return self._vars_by_name[var_name]
 
+    def domain_sizes(self):
+        """Returns a dict from variable names to the sizes of their domains."""
+        return {name: len(var.get_domain()) for name, var in self._vars_by_name.items()}
+
     def get_factors(self):
         return self._factors
 
@@ -33,28 +40,152 @@ class BayesianNetwork:
                 edges += [(var, neighbor) for neighbor in vars[:i] + vars[i + 1:]]
         return UndirectedGraph(nodes, edges)
 
+    def to_dense(self, log_domain=False):
+        """Returns an equivalent network whose factors are DenseFactors.
+
+        With log_domain=True the factors store log-probabilities, which keeps
+        inference on very large networks from underflowing.
+        """
+        return BayesianNetwork([factor.to_dense(log_domain) for factor in self._factors])
+
+    def to_sparse(self):
+        """Returns an equivalent network whose factors are SparseFactors."""
+        return BayesianNetwork([factor.to_sparse() for factor in self._factors])
+
+    def prune(self, query_vars, evidence):
+        """Removes the factors that cannot affect P(query_vars | evidence).
+
+        Factors are read as CPTs whose last variable is the child. Two kinds
+        of factors are dropped:
+          - those of barren nodes, i.e. unobserved, unqueried nodes without
+            children and with a single CPT (repeatedly, so whole unobserved
+            subtrees go away);
+          - those that do not touch a variable connected to a query variable
+            in the moral graph once the observed variables are removed. Such
+            variables are d-separated from the query by the evidence, so
+            their factors only scale the posterior by a constant.
+
+        Parameters
+        ----------
+        query_vars : iterable[str]
+            The names of the query variables.
+        evidence : dict[str, str]
+            The observed value of each evidence variable.
+
+        Returns
+        -------
+        (BayesianNetwork, PruningReport)
+            The pruned network, and a summary of what was removed.
+        """
+
+        query_vars = set(query_vars)
+        needed = query_vars | set(evidence)
+        child_count = defaultdict(int)
+        factors_by_child = defaultdict(list)
+        for factor in self._factors:
+            factors_by_child[factor.get_variables()[-1].get_name()].append(factor)
+            for var in factor.get_variables()[:-1]:
+                child_count[var.get_name()] += 1
+        barren = set()
+        removed = set()
+        candidates = [name for name in factors_by_child if child_count[name] == 0]
+        while len(candidates) > 0:
+            name = candidates.pop()
+            if name in needed or name in barren or len(factors_by_child[name]) != 1:
+                continue
+            barren.add(name)
+            for factor in factors_by_child[name]:
+                removed.add(id(factor))
+                for var in factor.get_variables()[:-1]:
+                    child_count[var.get_name()] -= 1
+                    if child_count[var.get_name()] == 0:
+                        candidates.append(var.get_name())
+        remaining = [factor for factor in self._factors if id(factor) not in removed]
+        neighbors = defaultdict(set)
+        for factor in remaining:
+            names = [var.get_name() for var in factor.get_variables()]
+            for name in names:
+                neighbors[name].update(names)
+        connected = set()
+        frontier = [name for name in query_vars if name not in evidence]
+        while len(frontier) > 0:
+            name = frontier.pop()
+            if name not in connected:
+                connected.add(name)
+                frontier.extend(n for n in neighbors[name] if n not in evidence)
+        kept = [factor for factor in remaining
+                if any(var.get_name() in connected for var in factor.get_variables())]
+        pruned = BayesianNetwork(kept)
+        disconnected = {v.get_name() for factor in remaining for v in factor.get_variables()}
+        disconnected -= {v.get_name() for v in pruned.get_variables()}
+        report = PruningReport(len(self._variables), len(pruned.get_variables()),
+                               len(self._factors), len(kept), barren, disconnected)
+        return pruned, report
+
     def reduce(self, evidence):
         reduced_factors = [factor.reduce(evidence) for factor in self._factors]
         return BayesianNetwork(reduced_factors)
 
     def get_value(self, instantiation):
-        g = multiply(self._factors)
-        return g.get_value(instantiation)
+        """Returns the product of the factors at an instantiation.
+
+        If every variable is instantiated, this just multiplies one entry of
+        each factor. Otherwise the leftover variables are summed out with a
+        single contraction, without building the product table.
+        """
+        if all(name in instantiation for name in self._vars_by_name):
+            value = 1.0
+            for factor in self._factors:
+                value *= factor.get_value(instantiation)
+            return value
+        reduced = [factor.reduce(instantiation) for factor in self._factors]
+        return multiply_marginalize(reduced, []).get_value({})
+
+
+class PruningReport:
+    """Summarizes how much of a network BayesianNetwork.prune removed."""
+
+    def __init__(self, variables_before, variables_after, factors_before, factors_after,
+                 barren, disconnected):
+        self.variables_before = variables_before
+        self.variables_after = variables_after
+        self.factors_before = factors_before
+        self.factors_after = factors_after
+        self.barren = barren
+        self.disconnected = disconnected
+
+    def fraction_removed(self):
+        """Returns the fraction of the factors that were pruned away."""
+        if self.factors_before == 0:
+            return 0.0
+        return 1.0 - self.factors_after / self.factors_before
+
+    def __str__(self):
+        return (f"pruned {self.factors_before - self.factors_after} of {self.factors_before} factors "
+                f"({len(self.barren)} barren, {len(self.disconnected)} d-separated variables); "
+                f"{self.variables_after} of {self.variables_before} variables remain")
 
 
 class UndirectedGraph:
 
     def __init__(self, nodes, edges):
         self.nodes = nodes
-        self.adjacency = defaultdict(set)
+        self.adjacency = {node: set() for node in nodes}
         for (node1, node2) in edges:
-            self.adjacency[node1].add(node2)
-            self.adjacency[node2].add(node1)
-        self.adjacency = dict(self.adjacency)
+            self.adjacency.setdefault(node1, set()).add(node2)
+            self.adjacency.setdefault(node2, set()).add(node1)
 
     def get_neighbors(self, node):
         return self.adjacency[node]
 
+    def subgraph(self, nodes):
+        """Returns the subgraph induced by the given nodes."""
+        keep = set(nodes)
+        nodes = [node for node in self.nodes if node in keep]
+        edges = [(node, neighbor) for node in self.adjacency if node in keep
+                 for neighbor in self.adjacency[node] if neighbor in keep]
+        return UndirectedGraph(nodes, edges)
+
     def get_edges(self):
         result = set()
         for node in self.adjacency:
@@ -4,12 +4,14 @@ import pygame as pg
 import threading
 from bayes import BayesianNetwork
 from junction import BeliefPropagation
-from junction import build_junction_tree_for_bayes_net
-from genetics import Male, Female, create_family_bayes_net
+from genetics import Male, Female, compile_family_junction_tree
 from graphics import CartesianPlane, AnimatedSprite, PlayButton
 from graphics import RainbowOverlay, FamilyMemberWidget
 
 
+JUNCTION_TREE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.jtree_cache')
+
+
 class VictoriaBloodlines:
     def __init__(self):
         self.plane = CartesianPlane(30, 21, 1000, 700, bg_image_file="images/royals.png")
@@ -25,8 +27,8 @@ class VictoriaBloodlines:
         self.plane.add_sprite(self.overlay)
         self.button = PlayButton(17.4, 3.5, scale=2.0)
         self.plane.add_sprite(self.button)
-        self.bnet = create_family_bayes_net(family)
-        self.jtree = build_junction_tree_for_bayes_net(self.bnet)
+        self.jtree = compile_family_junction_tree(family, cache_dir=JUNCTION_TREE_CACHE)
+        self.bp = BeliefPropagation(self.jtree)
         self.running_bp = False
 
     def harvest_evidence(self):
@@ -60,9 +62,9 @@ class VictoriaBloodlines:
 
     def run_belief_propagation(self, evidence):
         self.running_bp = True
-        bp = BeliefPropagation(self.jtree)
-        bp.run(evidence)
-        marginals = bp.get_marginals()
+        self.bp.update(evidence)
+        marginals = self.bp.get_marginals([f'G_{person.get_name()}'
+                                           for person in self.family_widgets])
         for person in self.family_widgets:
             if person.get_color() != (255, 0, 0):
                 try:
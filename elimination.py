@@ -1,23 +1,116 @@
-from factor import multiply
+from collections import defaultdict
+import heapq
+from math import prod
+import numpy as np
+from factor import multiply_dense, multiply_marginalize, multiply_maximize
 from bayes import BayesianNetwork
 
 
-def min_degree_elim_order(moral_graph):
-    def min_degree_node(adjacency):
-        best, best_degree = None, float("inf")
-        for node in adjacency:
-            if len(adjacency[node]) < best_degree:
-                best, best_degree = node, len(adjacency[node])
-        return best
-    adjacencies = moral_graph.adjacency
+def greedy_elim_order(moral_graph, score):
+    """Builds an elimination order by greedily eliminating the best node.
+
+    Eliminating a node connects all of its neighbors (the fill-in edges) and
+    removes it from the graph. Candidates are kept in a heap; since only the
+    nodes near an eliminated node can change score, only those are rescored,
+    and outdated heap entries are skipped when popped.
+
+    Parameters
+    ----------
+    moral_graph : UndirectedGraph
+        The graph to triangulate.
+    score : function
+        Maps (node, adjacency) to the cost of eliminating the node next, where
+        adjacency is the current adjacency dict. Lower is better.
+
+    Returns
+    -------
+    list[str]
+        The elimination order.
+    """
+
+    adjacency = {node: set(neighbors) for node, neighbors in moral_graph.adjacency.items()}
+    rank = {node: i for i, node in enumerate(adjacency)}
+    scores = {node: score(node, adjacency) for node in adjacency}
+    heap = [(scores[node], rank[node], node) for node in adjacency]
+    heapq.heapify(heap)
     elim_order = []
-    while len(adjacencies) > 0:
-        min_degree = min_degree_node(adjacencies)
-        adjacencies = {n: adjacencies[n] - {min_degree} for n in adjacencies if n != min_degree}
-        elim_order.append(min_degree)
+    while len(heap) > 0:
+        node_score, _, node = heapq.heappop(heap)
+        if node not in adjacency or scores[node] != node_score:
+            continue
+        neighbors = adjacency.pop(node)
+        for neighbor in neighbors:
+            adjacency[neighbor].discard(node)
+            adjacency[neighbor] |= neighbors - {neighbor}
+        affected = set(neighbors)
+        for neighbor in neighbors:
+            affected |= adjacency[neighbor]
+        for other in affected:
+            new_score = score(other, adjacency)
+            if new_score != scores[other]:
+                scores[other] = new_score
+                heapq.heappush(heap, (new_score, rank[other], other))
+        elim_order.append(node)
     return elim_order
 
 
+def min_degree_elim_order(moral_graph, domain_sizes=None):
+    """Orders the nodes by repeatedly eliminating one with the fewest neighbors."""
+    return greedy_elim_order(moral_graph, lambda node, adjacency: len(adjacency[node]))
+
+
+def min_fill_elim_order(moral_graph, domain_sizes=None):
+    """Orders the nodes by repeatedly eliminating one that adds the fewest fill-in edges."""
+    def fill_in(node, adjacency):
+        neighbors = list(adjacency[node])
+        return sum(1 for i, a in enumerate(neighbors) for b in neighbors[i + 1:]
+                   if b not in adjacency[a])
+    return greedy_elim_order(moral_graph, fill_in)
+
+
+def weighted_min_fill_elim_order(moral_graph, domain_sizes):
+    """Like min-fill, but each fill-in edge costs the product of the domain
+    sizes of its endpoints, so edges between large variables are avoided."""
+    def weighted_fill_in(node, adjacency):
+        neighbors = list(adjacency[node])
+        return sum(domain_sizes[a] * domain_sizes[b]
+                   for i, a in enumerate(neighbors) for b in neighbors[i + 1:]
+                   if b not in adjacency[a])
+    return greedy_elim_order(moral_graph, weighted_fill_in)
+
+
+def elim_order_stats(moral_graph, elim_order, domain_sizes):
+    """Measures the cost of an elimination order without running inference.
+
+    Parameters
+    ----------
+    moral_graph : UndirectedGraph
+        The graph the order was computed for.
+    elim_order : list[str]
+        The elimination order.
+    domain_sizes : dict[str, int]
+        The domain size of each variable.
+
+    Returns
+    -------
+    (int, int)
+        The induced width of the order (the size of its largest elimination
+        clique, minus one) and the number of entries in the largest clique table.
+    """
+
+    adjacency = {node: set(neighbors) for node, neighbors in moral_graph.adjacency.items()}
+    width, largest_table = 0, 1
+    for node in elim_order:
+        neighbors = adjacency.pop(node, set())
+        for neighbor in neighbors:
+            adjacency[neighbor].discard(node)
+            adjacency[neighbor] |= neighbors - {neighbor}
+        width = max(width, len(neighbors))
+        largest_table = max(largest_table,
+                            domain_sizes[node] * prod(domain_sizes[n] for n in neighbors))
+    return width, largest_table
+
+
 def eliminate(bnet, var_name):
     variable = bnet.get_variable_by_name(var_name)
     relevant = []
@@ -27,11 +120,51 @@ def eliminate(bnet, var_name):
             relevant.append(factor)
         else:
             irrelevant.append(factor)
-    new_factor = multiply(relevant)
-    new_factor = new_factor.sum_out(variable)
+    remaining = {v.get_name() for factor in relevant for v in factor.get_variables()} - {var_name}
+    new_factor = multiply_marginalize(relevant, remaining)
     return BayesianNetwork(irrelevant + [new_factor])
 
 
+def eliminate_all(factors, elim_order):
+    """Eliminates variables from a list of factors, in the given order.
+
+    Factors are indexed by variable name, so each step only touches the
+    factors that mention the variable being eliminated.
+
+    Parameters
+    ----------
+    factors : list[Factor]
+        The factors to eliminate from.
+    elim_order : list[str]
+        The names of the variables to sum out.
+
+    Returns
+    -------
+    list[Factor]
+        The factors left after the eliminations.
+    """
+
+    live = dict(enumerate(factors))
+    index = defaultdict(set)
+    for i, factor in live.items():
+        for var in factor.get_variables():
+            index[var.get_name()].add(i)
+    next_id = len(live)
+    for var_name in elim_order:
+        ids = index.pop(var_name, set())
+        if len(ids) == 0:
+            continue
+        relevant = [live.pop(i) for i in ids]
+        remaining = {v.get_name() for factor in relevant for v in factor.get_variables()} - {var_name}
+        for name in remaining:
+            index[name] -= ids
+        live[next_id] = multiply_marginalize(relevant, remaining)
+        for name in remaining:
+            index[name].add(next_id)
+        next_id += 1
+    return list(live.values())
+
+
 def variable_elimination(bnet, evidence, elim_order):
     bnet = bnet.reduce(evidence)
     while len(elim_order) > 0:
@@ -41,10 +174,159 @@ def variable_elimination(bnet, evidence, elim_order):
     return bnet.get_value(evidence)
 
 
-def conditional_prob(bnet, event, evidence):
-    event_and_evidence = {**event, **evidence}
-    elim_order = min_degree_elim_order(bnet.moral_graph())
-    numerator = variable_elimination(bnet, event_and_evidence, elim_order)
-    denominator = variable_elimination(bnet, evidence, elim_order)
-    return numerator / denominator
-        
+class QueryEngine:
+    """Computes posteriors on a Bayesian network with one elimination pass.
+
+    Evidence is absorbed up front: each factor is reduced by the evidence and
+    then summed over its observed variables, which removes them from the
+    problem. Everything except the query variables is then eliminated and the
+    result is normalized. Elimination orders are computed on the moral graph
+    without the observed variables, and cached per set of evidence variables.
+
+    Unless prune=False, each query first drops the barren and d-separated
+    parts of the network (see BayesianNetwork.prune); the report of the last
+    query is kept in last_pruning_report.
+    """
+
+    def __init__(self, bnet, heuristic=min_degree_elim_order, prune=True):
+        self.bnet = bnet
+        self.heuristic = heuristic
+        self.prune = prune
+        self.last_pruning_report = None
+        self._moral_graph = None
+        self._elim_orders = dict()
+
+    def _graph(self, evidence_vars):
+        if self._moral_graph is None:
+            self._moral_graph = self.bnet.moral_graph()
+        return self._moral_graph.subgraph([n for n in self._moral_graph.nodes
+                                           if n not in evidence_vars])
+
+    def elim_order(self, evidence_vars):
+        key = frozenset(evidence_vars)
+        if key not in self._elim_orders:
+            self._elim_orders[key] = self.heuristic(self._graph(key), self.bnet.domain_sizes())
+        return self._elim_orders[key]
+
+    def order_stats(self, evidence_vars):
+        """Returns the induced width and largest table size of the elimination
+        order used for this set of evidence variables (see elim_order_stats)."""
+        return elim_order_stats(self._graph(frozenset(evidence_vars)),
+                                self.elim_order(evidence_vars), self.bnet.domain_sizes())
+
+    def posterior(self, query_vars, evidence):
+        """Computes the distribution of the query variables given the evidence.
+
+        Parameters
+        ----------
+        query_vars : iterable[str]
+            The names of the query variables.
+        evidence : dict[str, str]
+            The observed value of each evidence variable.
+
+        Returns
+        -------
+        Factor
+            The normalized posterior over the query variables.
+        """
+
+        query_vars = set(query_vars) - set(evidence)
+        factors = self._absorb_evidence(query_vars, evidence)
+        elim_order = [var for var in self.elim_order(evidence) if var not in query_vars]
+        factors = eliminate_all(factors, elim_order)
+        return multiply_marginalize(factors, query_vars).normalize()
+
+    def map_assignment(self, map_vars, evidence):
+        """Finds the most probable joint assignment of some variables (MAP).
+
+        The elimination order is constrained so that every other variable is
+        summed out first; the MAP variables are then maximized out in the
+        remaining order, keeping each bucket's product so that the argmax can
+        be traced back. With every unobserved variable in map_vars, this is
+        the most probable explanation (MPE).
+
+        Parameters
+        ----------
+        map_vars : iterable[str]
+            The names of the variables to assign.
+        evidence : dict[str, str]
+            The observed value of each evidence variable.
+
+        Returns
+        -------
+        dict[str, str]
+            The most probable value of each MAP variable given the evidence.
+        """
+
+        observed = {var: evidence[var] for var in map_vars if var in evidence}
+        map_vars = set(map_vars) - set(evidence)
+        factors = self._absorb_evidence(map_vars, evidence)
+        elim_order = self.elim_order(evidence)
+        factors = eliminate_all(factors, [var for var in elim_order if var not in map_vars])
+        # As in eliminate_all, factors are indexed by variable name so that
+        # each step only touches the factors that mention its variable.
+        live = dict(enumerate(factors))
+        index = defaultdict(set)
+        for i, factor in live.items():
+            for var in factor.get_variables():
+                index[var.get_name()].add(i)
+        next_id = len(live)
+        buckets = []
+        for var_name in [var for var in elim_order if var in map_vars]:
+            ids = index.pop(var_name, set())
+            product = multiply_dense([live.pop(i) for i in ids])
+            buckets.append((var_name, product))
+            remaining = {v.get_name() for v in product.get_variables()} - {var_name}
+            for name in remaining:
+                index[name] -= ids
+            live[next_id] = multiply_maximize([product], remaining)
+            for name in remaining:
+                index[name].add(next_id)
+            next_id += 1
+        assignment = dict()
+        for var_name, product in reversed(buckets):
+            product = product.reduce(assignment)
+            table = product.get_table()
+            codes = np.unravel_index(np.argmax(table), table.shape)
+            var = product.get_variable(var_name)
+            assignment[var_name] = var.get_domain()[codes[product.get_variables().index(var)]]
+        assignment.update(observed)
+        return assignment
+
+    def _absorb_evidence(self, query_vars, evidence):
+        """Returns the (optionally pruned) factors of the network, reduced by
+        the evidence and summed over the observed variables."""
+        bnet = self.bnet
+        if self.prune:
+            bnet, self.last_pruning_report = bnet.prune(query_vars, evidence)
+        factors = []
+        for factor in bnet.get_factors():
+            conditioned = factor.reduce(evidence)
+            for var in factor.get_variables():
+                if var.get_name() in evidence:
+                    conditioned = conditioned.sum_out(var)
+            factors.append(conditioned)
+        return factors
+
+
+def query_engine(bnet, heuristic=min_degree_elim_order):
+    """Returns the QueryEngine for a network and heuristic, creating it on
+    first use. Engines are cached on the network itself."""
+    engines = bnet._query_engines
+    if heuristic not in engines:
+        engines[heuristic] = QueryEngine(bnet, heuristic)
+    return engines[heuristic]
+
+
+def conditional_prob(bnet, event, evidence, heuristic=min_degree_elim_order):
+    for var, value in event.items():
+        if var in evidence and evidence[var] != value:
+            return 0.0
+    posterior = query_engine(bnet, heuristic).posterior(event.keys(), evidence)
+    return posterior.get_value(event)
+
+
+def map_assignment(bnet, map_vars, evidence, heuristic=min_degree_elim_order):
+    """Returns the most probable joint assignment of map_vars given the
+    evidence (see QueryEngine.map_assignment)."""
+    return query_engine(bnet, heuristic).map_assignment(map_vars, evidence)
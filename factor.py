@@ -1,11 +1,53 @@
+from collections import defaultdict
+import heapq
+from itertools import product
+from math import prod
+from types import MappingProxyType
+import numpy as np
+
+
+class VariableRegistry:
+    """Interns variables.
+
+    Each distinct (name, domain) pair is given a dense integer id, and each
+    value of its domain an integer code (its index in the domain). Variables
+    built from the same name and domain share the id and the code table, so
+    they hash and compare as integers. Code tables depend only on the
+    domain, so one table is shared by all the variables with that domain.
+    """
+
+    def __init__(self):
+        self._ids = dict()
+        self._codes = []
+        self._codes_by_domain = dict()
+
+    def intern(self, name, domain):
+        """Returns the id and the value-to-code map of a variable."""
+        key = (name, domain)
+        if key not in self._ids:
+            self._ids[key] = len(self._codes)
+            if domain not in self._codes_by_domain:
+                self._codes_by_domain[domain] = {value: code for code, value in enumerate(domain)}
+            self._codes.append(self._codes_by_domain[domain])
+        var_id = self._ids[key]
+        return var_id, self._codes[var_id]
+
+    def __len__(self):
+        return len(self._codes)
+
+
+REGISTRY = VariableRegistry()
 
 
 class Variable:
     """A variable and its domain."""
 
+    __slots__ = ('_name', '_domain', '_id', '_codes')
+
     def __init__(self, name, domain):
         self._name = name
         self._domain = tuple(domain)
+        self._id, self._codes = REGISTRY.intern(self._name, self._domain)
 
     def get_name(self):
         return self._name
@@ -13,8 +55,15 @@ class Variable:
     def get_domain(self):
         return self._domain
 
+    def get_id(self):
+        return self._id
+
+    def encode(self, value):
+        """Returns the integer code of a domain value (KeyError if absent)."""
+        return self._codes[value]
+
     def __hash__(self):
-        return hash(self._name)
+        return hash(self._id)
 
     def __lt__(self, other):
         return self._name < other.get_name()
@@ -26,16 +75,46 @@ class Variable:
         return self._name
 
     def __eq__(self, other):
-        return other.get_name() == self._name and other.get_domain() == self._domain
+        return isinstance(other, Variable) and other._id == self._id
+
+    def __reduce__(self):
+        # Ids are only meaningful within one process, so re-intern on unpickling.
+        return Variable, (self._name, self._domain)
 
 
+def encode_evidence(variables, evidence):
+    """Converts evidence into (position, code) pairs for the given variables.
+
+    Variables that are not observed are skipped. A value outside a variable's
+    domain gets code -1, which matches no row.
+    """
+
+    return [(i, var._codes.get(evidence[var.get_name()], -1))
+            for i, var in enumerate(variables) if var.get_name() in evidence]
+
 
 class Factor:
+    """A factor stored as a dict from instantiations to values.
+
+    The constructor takes tuples of domain values as keys. Internally, each
+    key is stored as the tuple of the values' integer codes.
+    """
+
+    __slots__ = ('_variables', '_values')
 
     def __init__(self, variables, values):
         self._variables = variables
-        self._values = values
-    
+        self._values = {tuple(var.encode(v) for var, v in zip(variables, event)): value
+                        for event, value in values.items()}
+
+    @classmethod
+    def from_codes(cls, variables, values):
+        """Builds a factor from a dict whose keys are already integer-coded."""
+        factor = cls.__new__(cls)
+        factor._variables = variables
+        factor._values = values
+        return factor
+
     def get_variables(self):
         """Returns the variables of the factor.
 
@@ -58,23 +137,19 @@ class Factor:
         for var in self._variables:
             if var.get_name() not in instantiation:
                 raise Exception('Variable {} not found in given instantiation.'.format(var))
-            key.append(instantiation[var.get_name()])
+            key.append(var.encode(instantiation[var.get_name()]))
         return self._values[tuple(key)]
 
     def normalize(self):
-        normalizer = sum([v for _, v in self._values.items()])
-        return Factor(self._variables, {k: v/normalizer for (k, v) in self._values.items()})
+        normalizer = sum(self._values.values())
+        return self.from_codes(self._variables,
+                               {k: v/normalizer for (k, v) in self._values.items()})
 
     def reduce(self, evidence):
-        reduced_values = dict()
-        for event in self._values:
-            keep_row = True
-            for var, value in zip(self._variables, event):
-                if var.get_name() in evidence and evidence[var.get_name()] != value:
-                    keep_row = False
-            if keep_row:
-                reduced_values[event] = self._values[event]
-        return Factor(self._variables, reduced_values)
+        observed = encode_evidence(self._variables, evidence)
+        reduced_values = {event: value for event, value in self._values.items()
+                          if all(event[i] == code for i, code in observed)}
+        return self.from_codes(self._variables, reduced_values)
 
     def sum_out(self, variable):
         if variable not in self._variables:
@@ -83,26 +158,333 @@ class Factor:
             variable_index = self._variables.index(variable)
             other_variables = self._variables[0:variable_index] + self._variables[variable_index + 1:]
             new_values = dict()
-            for inst in instantiations(other_variables):
+            for inst in product(*[range(len(var.get_domain())) for var in other_variables]):
                 result = 0.0
-                for value in variable.get_domain():
+                for code in range(len(variable.get_domain())):
                     try:
-                        lookup_inst = inst[0:variable_index] + (value,) + inst[variable_index:]
+                        lookup_inst = inst[0:variable_index] + (code,) + inst[variable_index:]
                         result += self._values[lookup_inst]
                     except KeyError:
                         pass
                 new_values[inst] = result
-            return Factor(other_variables, new_values)
+            return Factor.from_codes(other_variables, new_values)
+
+    def to_dense(self, log_domain=False):
+        """Converts the factor into a DenseFactor.
+
+        Rows that are absent from the table become zeros.
+
+        Parameters
+        ----------
+        log_domain : bool
+            Whether the dense factor should store log-probabilities.
+
+        Returns
+        -------
+        DenseFactor
+            A factor with the same variables and values.
+        """
+
+        table = np.zeros([len(var.get_domain()) for var in self._variables])
+        for event, value in self._values.items():
+            table[event] = value
+        return DenseFactor(self._variables, table).to_dense(log_domain)
+
+    def support_mask(self):
+        """Returns a boolean array, shaped like the table of to_dense(), that
+        marks the rows stored in the factor."""
+        mask = np.zeros([len(var.get_domain()) for var in self._variables], dtype=bool)
+        for event in self._values:
+            mask[event] = True
+        return mask
+
+    def to_sparse(self):
+        """Converts the factor into a SparseFactor (dropping its zero rows)."""
+        return SparseFactor.from_codes(self._variables, self._values)
 
     def __str__(self):
         result = f"{self._variables}:"
         for event, value in self._values.items():
+            event = tuple(var.get_domain()[code] for var, code in zip(self._variables, event))
             result += f"\n  {event}: {value}"
         return result
 
     __repr__ = __str__
 
 
+class SparseFactor(Factor):
+    """A dict-based factor that only stores its nonzero rows.
+
+    Deterministic CPTs are mostly zeros, so skipping those rows saves both
+    memory and the work of multiplying and summing them. Rows that are not
+    stored have value 0.0.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, variables, values):
+        super().__init__(variables, {k: v for (k, v) in values.items() if v != 0.0})
+
+    @classmethod
+    def from_codes(cls, variables, values):
+        return super().from_codes(variables, {k: v for (k, v) in values.items() if v != 0.0})
+
+    def get_value(self, instantiation):
+        try:
+            return super().get_value(instantiation)
+        except KeyError:
+            return 0.0
+
+    def sum_out(self, variable):
+        if variable not in self._variables:
+            raise Exception('Variable {} not found.'.format(variable))
+        variable_index = self._variables.index(variable)
+        other_variables = self._variables[0:variable_index] + self._variables[variable_index + 1:]
+        new_values = defaultdict(float)
+        for event, value in self._values.items():
+            new_values[event[0:variable_index] + event[variable_index + 1:]] += value
+        return SparseFactor.from_codes(other_variables, new_values)
+
+    def to_sparse(self):
+        return self
+
+
+class FactorTemplate:
+    """A value table shared by many factors that differ only in their variables.
+
+    CPTs such as those of a pedigree repeat one table for every person. A
+    template encodes and freezes the values once; bind() attaches them to a
+    list of variables without copying, so each bound factor costs O(1)
+    memory, and the dense table used by inference is built once per
+    template rather than once per factor.
+
+    The constructor takes the domain of each variable, in order, and a dict
+    from tuples of domain values to values (as Factor does).
+    """
+
+    __slots__ = ('_domains', '_values', '_tables')
+
+    def __init__(self, domains, values):
+        self._domains = [tuple(domain) for domain in domains]
+        codes = [{value: code for code, value in enumerate(domain)} for domain in self._domains]
+        self._values = MappingProxyType({tuple(c[v] for c, v in zip(codes, event)): value
+                                         for event, value in values.items()})
+        self._tables = dict()
+
+    @classmethod
+    def from_table(cls, domains, table):
+        """Builds a template from an array with one axis per variable (in the
+        order of domains), e.g. a slice of a precomputed tensor."""
+        table = np.array(table, dtype=float)
+        domains = [tuple(domain) for domain in domains]
+        if table.shape != tuple(len(domain) for domain in domains):
+            raise ValueError('Table shape {} does not match the domains {}'.format(table.shape, domains))
+        template = cls.__new__(cls)
+        template._domains = domains
+        template._values = MappingProxyType(dict(zip(np.ndindex(table.shape), table.ravel().tolist())))
+        table.flags.writeable = False
+        template._tables = {False: table}
+        return template
+
+    def bind(self, variables):
+        """Returns a factor over the given variables with the shared values."""
+        for var, domain in zip(variables, self._domains):
+            if var.get_domain() != domain:
+                raise ValueError('Variable {} does not match the template domain {}'.format(var, domain))
+        return TemplateFactor.from_template(self, variables)
+
+    def dense_table(self, log_domain=False):
+        """Returns the (cached, read-only) dense table of the template."""
+        if log_domain not in self._tables:
+            table = np.zeros([len(domain) for domain in self._domains])
+            for event, value in self._values.items():
+                table[event] = value
+            if log_domain:
+                with np.errstate(divide='ignore'):
+                    table = np.log(table)
+            table.flags.writeable = False
+            self._tables[log_domain] = table
+        return self._tables[log_domain]
+
+    def __reduce__(self):
+        values = {tuple(domain[code] for domain, code in zip(self._domains, event)): value
+                  for event, value in self._values.items()}
+        return FactorTemplate, (self._domains, values)
+
+
+class TemplateFactor(Factor):
+    """A Factor whose values are those of a shared FactorTemplate.
+
+    Operations that derive new values (reduce, normalize, sum_out) return
+    ordinary Factors.
+    """
+
+    __slots__ = ('_template',)
+
+    @classmethod
+    def from_template(cls, template, variables):
+        factor = cls.__new__(cls)
+        factor._variables = variables
+        factor._values = template._values
+        factor._template = template
+        return factor
+
+    @classmethod
+    def from_codes(cls, variables, values):
+        return Factor.from_codes(variables, values)
+
+    def get_template(self):
+        return self._template
+
+    def to_dense(self, log_domain=False):
+        return DenseFactor(self._variables, self._template.dense_table(log_domain), log_domain)
+
+    def __reduce__(self):
+        return self._template.bind, (self._variables,)
+
+
+class DenseFactor:
+    """A factor whose values are stored in an N-d NumPy array.
+
+    The array has one axis per variable (in the order of the variable list),
+    and the values of each variable's domain are mapped to the integer indices
+    along that axis. Rows that are impossible are simply zeros.
+
+    In log domain, the array holds natural logs of the values instead (with
+    -inf for impossible rows), products become sums and marginalization uses
+    logsumexp, so long products of small probabilities do not underflow.
+    """
+
+    __slots__ = ('_variables', '_table', '_log_domain')
+
+    def __init__(self, variables, table, log_domain=False):
+        self._variables = list(variables)
+        self._table = np.asarray(table, dtype=float)
+        self._log_domain = log_domain
+        expected_shape = tuple(len(var.get_domain()) for var in self._variables)
+        if self._table.shape != expected_shape:
+            raise ValueError('Table shape {} does not match the domains {}.'.format(
+                self._table.shape, expected_shape))
+
+    def get_variables(self):
+        """Returns the variables of the factor.
+
+        Returns
+        -------
+        list[Variable]
+            The variables of the factor.
+        """
+
+        return self._variables
+
+    def get_variable(self, name):
+        for var in self._variables:
+            if var.get_name() == name:
+                return var
+        return None
+
+    def get_table(self):
+        """Returns the underlying array (one axis per variable)."""
+        return self._table
+
+    def is_log_domain(self):
+        return self._log_domain
+
+    def get_value(self, instantiation):
+        value = float(self._table[self._index(instantiation)])
+        return float(np.exp(value)) if self._log_domain else value
+
+    def get_log_value(self, instantiation):
+        value = float(self._table[self._index(instantiation)])
+        return value if self._log_domain else float(np.log(value))
+
+    def normalize(self):
+        if self._log_domain:
+            return DenseFactor(self._variables, self._table - logsumexp(self._table),
+                               log_domain=True)
+        return DenseFactor(self._variables, self._table / self._table.sum())
+
+    def reduce(self, evidence):
+        mask = self._evidence_mask(evidence)
+        if mask is None:
+            return self
+        if self._log_domain:
+            table = np.where(mask > 0, self._table, -np.inf)
+            return DenseFactor(self._variables, table, log_domain=True)
+        return DenseFactor(self._variables, self._table * mask)
+
+    def sum_out(self, variable):
+        if variable not in self._variables:
+            raise Exception('Variable {} not found.'.format(variable))
+        variable_index = self._variables.index(variable)
+        other_variables = self._variables[0:variable_index] + self._variables[variable_index + 1:]
+        if self._log_domain:
+            return DenseFactor(other_variables, logsumexp(self._table, axis=variable_index),
+                               log_domain=True)
+        return DenseFactor(other_variables, self._table.sum(axis=variable_index))
+
+    def to_dense(self, log_domain=False):
+        """Returns this factor, converted to or from log domain if needed."""
+        if log_domain == self._log_domain:
+            return self
+        if log_domain:
+            with np.errstate(divide='ignore'):
+                return DenseFactor(self._variables, np.log(self._table), log_domain=True)
+        return DenseFactor(self._variables, np.exp(self._table))
+
+    def to_sparse(self):
+        """Converts the factor into a SparseFactor holding its nonzero entries."""
+        table = np.exp(self._table) if self._log_domain else self._table
+        values = {tuple(int(i) for i in index): float(table[index])
+                  for index in zip(*np.nonzero(table))}
+        return SparseFactor.from_codes(self._variables, values)
+
+    def _index(self, instantiation):
+        key = []
+        for var in self._variables:
+            if var.get_name() not in instantiation:
+                raise Exception('Variable {} not found in given instantiation.'.format(var))
+            key.append(var.encode(instantiation[var.get_name()]))
+        return tuple(key)
+
+    def _evidence_mask(self, evidence):
+        """Builds a 0/1 array (broadcastable to the table) that zeroes out
+        every row inconsistent with the evidence, or None if no variable of
+        the factor is observed."""
+        mask = None
+        for axis, code in encode_evidence(self._variables, evidence):
+            shape = [1] * len(self._variables)
+            shape[axis] = len(self._variables[axis].get_domain())
+            axis_mask = np.zeros(shape[axis])
+            if code >= 0:
+                axis_mask[code] = 1.0
+            axis_mask = axis_mask.reshape(shape)
+            mask = axis_mask if mask is None else mask * axis_mask
+        return mask
+
+    def __str__(self):
+        result = f"{self._variables}:"
+        for index in np.ndindex(*self._table.shape):
+            event = tuple(var.get_domain()[i] for var, i in zip(self._variables, index))
+            result += f"\n  {event}: {self._table[index]}"
+        return result
+
+    __repr__ = __str__
+
+
+def logsumexp(table, axis=None):
+    """Computes log(sum(exp(table))) along an axis without underflow.
+
+    Slices that are entirely -inf (i.e. zero probability) stay -inf.
+    """
+
+    shift = np.max(table, axis=axis, keepdims=True)
+    shift = np.where(np.isfinite(shift), shift, 0.0)
+    with np.errstate(divide='ignore'):
+        result = np.log(np.sum(np.exp(table - shift), axis=axis, keepdims=True)) + shift
+    return np.squeeze(result, axis=axis) if axis is not None else result.reshape(())
+
+
 def instantiations(vars):
     """
     Takes a list of variables and returns the cross-product of the domains.
@@ -145,27 +527,411 @@ def multiply(factors):
     Returns
     -------
     Factor
-        The product of the input factors.
+        The product of the input factors. If any of the input factors is a
+        DenseFactor, the product is computed with array broadcasting and is
+        returned as a DenseFactor. Otherwise, if any of them is a SparseFactor,
+        only nonzero rows are joined and the result is a SparseFactor.
     """
 
-    def convert_instantiation_to_dict(variables):
-        result = dict()
-        for (var, value) in zip(variables, inst):
-            result[var.get_name()] = value
-        return result
-    all_vars = set()
-    for factor in factors:
-        all_vars = all_vars | set(factor.get_variables())
-    all_vars = list(all_vars)
+    if any(isinstance(factor, DenseFactor) for factor in factors):
+        return multiply_dense(factors)
+    if any(isinstance(factor, SparseFactor) for factor in factors):
+        return multiply_sparse(factors)
+
+    all_vars = union_of_variables(factors)
+    positions = [[all_vars.index(var) for var in factor.get_variables()] for factor in factors]
     values = dict()
-    for inst in instantiations(all_vars):
+    for inst in product(*[range(len(var.get_domain())) for var in all_vars]):
         try:
-            product = 1.0
-            inst_dict = convert_instantiation_to_dict(all_vars)
-            for factor in factors:
-                product *= factor.get_value(inst_dict)
-            values[inst] = product
+            result = 1.0
+            for factor, factor_positions in zip(factors, positions):
+                result *= factor._values[tuple(inst[i] for i in factor_positions)]
+            values[inst] = result
         except KeyError:
             pass
-    return Factor(all_vars, values)
-        
+    return Factor.from_codes(all_vars, values)
+
+
+def divide(numerator, denominator):
+    """Divides one factor by another whose variables are a subset of its own.
+
+    Following the usual convention for junction-tree separators, 0/0 is 0.
+
+    Parameters
+    ----------
+    numerator : Factor | DenseFactor
+        The factor to divide.
+    denominator : Factor | DenseFactor
+        The factor to divide by.
+
+    Returns
+    -------
+    DenseFactor
+        The quotient, over the variables of the numerator (in log domain if
+        either input is).
+    """
+
+    log_domain = is_log_domain(numerator) or is_log_domain(denominator)
+    numerator = numerator.to_dense(log_domain)
+    denominator = denominator.to_dense(log_domain)
+    variables = numerator.get_variables()
+    top, bottom = numerator.get_table(), align_table(denominator, variables)
+    if log_domain:
+        with np.errstate(invalid='ignore'):
+            table = np.where(np.isneginf(bottom), -np.inf, top - bottom)
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table = np.where(bottom == 0.0, 0.0, top / np.where(bottom == 0.0, 1.0, bottom))
+    return DenseFactor(variables, table, log_domain)
+
+
+def is_log_domain(factor):
+    """Checks whether a factor stores its values in log domain."""
+    return isinstance(factor, DenseFactor) and factor.is_log_domain()
+
+
+def union_of_variables(factors):
+    """Returns the variables of the given factors, in order of first appearance."""
+    result = []
+    seen = set()
+    for factor in factors:
+        for var in factor.get_variables():
+            if var not in seen:
+                seen.add(var)
+                result.append(var)
+    return result
+
+
+def align_table(factor, variables):
+    """Returns the table of a dense factor, transposed and reshaped so that it
+    broadcasts against an array with one axis per variable in `variables`."""
+    factor_vars = factor.get_variables()
+    axes = sorted(range(len(factor_vars)), key=lambda i: variables.index(factor_vars[i]))
+    table = np.transpose(factor.get_table(), axes)
+    shape = [1] * len(variables)
+    for var in factor_vars:
+        shape[variables.index(var)] = len(var.get_domain())
+    return table.reshape(shape)
+
+
+def multiply_dense(factors):
+    """Multiplies a list of factors using NumPy broadcasting.
+
+    Parameters
+    ----------
+    factors : list[Factor | DenseFactor]
+        The factors to multiply. Dict-based factors are converted first.
+
+    Returns
+    -------
+    DenseFactor
+        The product of the input factors (in log domain if any input is).
+    """
+
+    log_domain = any(is_log_domain(factor) for factor in factors)
+    factors = [factor.to_dense(log_domain) for factor in factors]
+    all_vars = union_of_variables(factors)
+    if log_domain:
+        table = np.zeros([len(var.get_domain()) for var in all_vars])
+        for factor in factors:
+            table = table + align_table(factor, all_vars)
+    else:
+        table = np.ones([len(var.get_domain()) for var in all_vars])
+        for factor in factors:
+            table = table * align_table(factor, all_vars)
+    return DenseFactor(all_vars, table, log_domain)
+
+
+def multiply_sparse(factors):
+    """Multiplies a list of dict-based factors, visiting only nonzero rows.
+
+    Parameters
+    ----------
+    factors : list[Factor | SparseFactor]
+        The factors to multiply.
+
+    Returns
+    -------
+    SparseFactor
+        The product of the input factors.
+    """
+
+    result = SparseFactor.from_codes([], {(): 1.0})
+    for factor in factors:
+        result = _join(result, factor)
+    return result
+
+
+def _join(left, right):
+    """Multiplies two dict-based factors with a hash join on their shared variables."""
+    left_vars, right_vars = left.get_variables(), right.get_variables()
+    left_shared = [i for i, var in enumerate(left_vars) if var in right_vars]
+    right_shared = [right_vars.index(left_vars[i]) for i in left_shared]
+    right_only = [i for i, var in enumerate(right_vars) if var not in left_vars]
+    index = defaultdict(list)
+    for event, value in right._values.items():
+        if value != 0.0:
+            index[tuple(event[i] for i in right_shared)].append(
+                (tuple(event[i] for i in right_only), value))
+    values = dict()
+    for event, value in left._values.items():
+        for extension, other_value in index.get(tuple(event[i] for i in left_shared), ()):
+            if value * other_value != 0.0:
+                values[event + extension] = value * other_value
+    return SparseFactor.from_codes(left_vars + [right_vars[i] for i in right_only], values)
+
+
+def _multiply_marginalize_sparse(factors, keep):
+    """Sparse counterpart of multiply_marginalize: follows the bucket plan of
+    contract, joining only the factors that mention the cheapest variable to
+    sum out and summing it out of their product."""
+    variables = union_of_variables(factors)
+    summed = set(var for var in variables if var.get_name() not in keep)
+    sizes = {var: len(var.get_domain()) for var in variables}
+
+    def eliminate(members, member_labels, bucket_output):
+        result = multiply_sparse(members)
+        for var in result.get_variables():
+            if var not in bucket_output:
+                result = result.sum_out(var)
+        return result
+
+    factors, _ = _eliminate_buckets(factors, [f.get_variables() for f in factors],
+                                    summed, sizes, eliminate)
+    return multiply_sparse(list(factors.values()))
+
+
+MAX_EINSUM_LABELS = 52
+MAX_EINSUM_OPERANDS = 32
+# Results of a single einsum whose largest entry is below this are redone
+# with rescaled intermediates, as they may have underflowed.
+UNDERFLOW_GUARD = 1e-200
+
+
+def multiply_marginalize(factors, keep):
+    """Multiplies a list of factors and sums out every variable not in `keep`.
+
+    The product is computed as an einsum contraction, so the full joint
+    over all the variables of the input factors is never materialized.
+
+    Parameters
+    ----------
+    factors : list[Factor | DenseFactor]
+        The factors to multiply.
+    keep : iterable[str]
+        The names of the variables to keep in the result.
+
+    Returns
+    -------
+    DenseFactor
+        The product of the input factors, marginalized onto the kept variables
+        (in log domain if any input is). If the inputs mix SparseFactors with
+        dict-based factors only, the product is joined sparsely instead and a
+        SparseFactor is returned.
+    """
+
+    if (any(isinstance(factor, SparseFactor) for factor in factors)
+            and not any(isinstance(factor, DenseFactor) for factor in factors)):
+        return _multiply_marginalize_sparse(factors, set(keep))
+    log_domain = any(is_log_domain(factor) for factor in factors)
+    factors = [factor.to_dense(log_domain) for factor in factors]
+    keep = set(keep)
+    kept_vars = [var for var in union_of_variables(factors) if var.get_name() in keep]
+    tables = []
+    shift = 0.0
+    for factor in factors:
+        table = factor.get_table()
+        if log_domain:
+            # Scale each table by its largest entry so that exponentiating
+            # it cannot underflow, and add the scales back at the end.
+            table_shift = np.max(table) if table.size > 0 else 0.0
+            table_shift = table_shift if np.isfinite(table_shift) else 0.0
+            table = np.exp(table - table_shift)
+            shift += table_shift
+        tables.append(table)
+    labels = [f.get_variables() for f in factors]
+    if log_domain:
+        # Intermediate tables are rescaled too, or a long product of small
+        # terms could still underflow inside the contraction.
+        result, log_scale = contract(tables, labels, kept_vars, log_scale=True)
+        with np.errstate(divide='ignore'):
+            return DenseFactor(kept_vars, np.log(result) + shift + log_scale, log_domain=True)
+    return DenseFactor(kept_vars, contract(tables, labels, kept_vars))
+
+
+def multiply_maximize(factors, keep):
+    """Multiplies a list of factors and maximizes out every variable not in `keep`.
+
+    This is the max-product counterpart of multiply_marginalize.
+
+    Parameters
+    ----------
+    factors : list[Factor | DenseFactor]
+        The factors to multiply.
+    keep : iterable[str]
+        The names of the variables to keep in the result.
+
+    Returns
+    -------
+    DenseFactor
+        For each assignment of the kept variables, the largest entry of the
+        product consistent with it (in log domain if any input is).
+    """
+
+    product = multiply_dense(factors)
+    keep = set(keep)
+    variables = product.get_variables()
+    axes = tuple(i for i, var in enumerate(variables) if var.get_name() not in keep)
+    kept_vars = [var for var in variables if var.get_name() in keep]
+    return DenseFactor(kept_vars, np.max(product.get_table(), axis=axes), product.is_log_domain())
+
+
+def contract(tables, labels, output, log_scale=False):
+    """Sums the product of several arrays over every label not in `output`.
+
+    This is einsum with arbitrary hashable labels (e.g. Variables). Small
+    contractions are handed to np.einsum in one call. Larger ones follow a
+    bucket-elimination plan: the summed-out labels are removed one at a time,
+    always picking the one whose bucket (the arrays that mention it) spans the
+    smallest table, and only the arrays in that bucket are multiplied.
+
+    Parameters
+    ----------
+    tables : list[np.ndarray]
+        The arrays to multiply.
+    labels : list[list]
+        For each array, the label of each of its axes.
+    output : list
+        The labels of the axes of the result, in order.
+    log_scale : bool
+        If set, divide every intermediate array by its largest entry as it is
+        formed and return the log of the total scale alongside the result, so
+        that products of many small numbers do not underflow. (A single einsum
+        call is still tried first, and kept if its result is far from
+        underflowing.)
+
+    Returns
+    -------
+    np.ndarray or (np.ndarray, float)
+        The contracted array, or the scaled array and the log of its scale
+        (the contraction is array * exp(log scale)).
+    """
+
+    scales = [] if log_scale else None
+    if len(tables) == 0:
+        return (np.array(1.0), 0.0) if log_scale else np.array(1.0)
+    all_labels = set(label for table_labels in labels for label in table_labels)
+    if len(tables) <= MAX_EINSUM_OPERANDS and len(all_labels) <= MAX_EINSUM_LABELS:
+        result = _einsum(tables, labels, output)
+        if not log_scale:
+            return result
+        if result.size == 0 or np.max(result) > UNDERFLOW_GUARD:
+            result = _rescale(result, scales)
+            return result, sum(scales)
+    sizes = {}
+    for table, table_labels in zip(tables, labels):
+        sizes.update(zip(table_labels, table.shape))
+    tables, labels = _eliminate_buckets(
+        tables, labels, all_labels - set(output), sizes,
+        lambda members, member_labels, bucket_output: _einsum_in_chunks(
+            members, member_labels, bucket_output, scales))
+    result = _einsum_in_chunks(list(tables.values()), list(labels.values()), output, scales)
+    return (result, sum(scales)) if log_scale else result
+
+
+def _eliminate_buckets(tables, labels, summed, sizes, eliminate):
+    """Runs the bucket-elimination plan of contract.
+
+    The labels in `summed` are removed one at a time, always picking the one
+    whose bucket (the tables that mention it) spans the smallest table.
+    eliminate(members, member_labels, bucket_output) must return the product
+    of the tables in the bucket with the label summed out, laid out along
+    bucket_output.
+
+    Returns
+    -------
+    (dict[int, object], dict[int, list])
+        The tables left once every label in `summed` is gone, and their labels.
+    """
+
+    tables = dict(enumerate(tables))
+    labels = {k: list(table_labels) for k, table_labels in enumerate(labels)}
+    buckets = defaultdict(set)
+    first_seen = dict()
+    for k, table_labels in labels.items():
+        for label in table_labels:
+            if label in summed:
+                buckets[label].add(k)
+                first_seen.setdefault(label, len(first_seen))
+
+    def bucket_labels(label):
+        return list(dict.fromkeys(l for k in sorted(buckets[label]) for l in labels[k]))
+
+    # Buckets and their costs are kept up to date as tables are replaced, and
+    # the cheapest bucket is found through a heap whose outdated entries are
+    # skipped, so each step only rescans the labels of the new table.
+    costs = {label: prod(sizes[l] for l in bucket_labels(label)) for label in buckets}
+    heap = [(cost, first_seen[label], label) for label, cost in costs.items()]
+    heapq.heapify(heap)
+    next_key = len(tables)
+    while len(heap) > 0:
+        cost, _, label = heapq.heappop(heap)
+        if label not in buckets or costs[label] != cost:
+            continue
+        bucket_output = [l for l in bucket_labels(label) if l != label]
+        members = sorted(buckets.pop(label))
+        table = eliminate([tables.pop(k) for k in members],
+                          [labels[k] for k in members], bucket_output)
+        for k in members:
+            for l in labels.pop(k):
+                if l in buckets:
+                    buckets[l].discard(k)
+        tables[next_key] = table
+        labels[next_key] = bucket_output
+        for l in bucket_output:
+            if l in buckets:
+                buckets[l].add(next_key)
+                costs[l] = prod(sizes[x] for x in bucket_labels(l))
+                heapq.heappush(heap, (costs[l], first_seen[l], l))
+        next_key += 1
+    return tables, labels
+
+
+def _einsum_in_chunks(tables, labels, output, scales=None):
+    """Calls _einsum, first multiplying the arrays together in groups if there
+    are more of them than np.einsum accepts at once. If `scales` is a list,
+    every array computed is divided by its largest entry and the log of that
+    entry is appended to the list."""
+    tables, labels = list(tables), list(labels)
+    while len(tables) > MAX_EINSUM_OPERANDS:
+        chunk_labels = list(dict.fromkeys(l for ls in labels[:MAX_EINSUM_OPERANDS] for l in ls))
+        table = _einsum(tables[:MAX_EINSUM_OPERANDS], labels[:MAX_EINSUM_OPERANDS], chunk_labels)
+        tables = [_rescale(table, scales)] + tables[MAX_EINSUM_OPERANDS:]
+        labels = [chunk_labels] + labels[MAX_EINSUM_OPERANDS:]
+    return _rescale(_einsum(tables, labels, output), scales)
+
+
+def _rescale(table, scales):
+    """Divides an array by its largest entry, recording the log of the entry
+    in `scales` (does nothing if `scales` is None or the array is all zeros)."""
+    if scales is None or table.size == 0:
+        return table
+    peak = np.max(table)
+    if not np.isfinite(peak) or peak <= 0:
+        return table
+    scales.append(float(np.log(peak)))
+    return table / peak
+
+
+def _einsum(tables, labels, output):
+    """Calls np.einsum after mapping arbitrary labels to integers."""
+    local = {label: i for i, label in
+             enumerate(dict.fromkeys(l for table_labels in labels for l in table_labels))}
+    operands = []
+    for table, table_labels in zip(tables, labels):
+        operands.append(table)
+        operands.append([local[label] for label in table_labels])
+    operands.append([local[label] for label in output])
+    # With one or two operands there is no contraction order to choose, and
+    # the path search would dominate the cost of small tables.
+    return np.einsum(*operands, optimize='greedy' if len(tables) > 2 else False)
@@ -1,11 +1,17 @@
-import numpy as np
+from collections import defaultdict, deque
+import csv
+import hashlib
 import os
-import pygame as pg
-from factor import Factor, Variable
+import tempfile
+import numpy as np
+from factor import DenseFactor, FactorTemplate, Variable
 from bayes import BayesianNetwork
+from junction import build_junction_tree_for_bayes_net, load_junction_tree, save_junction_tree
+from junction import BatchBeliefPropagation
 
 
 class FamilyMember:
+    __slots__ = ('name', 'sex', 'mother', 'father')
 
     def __init__(self, name, sex, mother, father):
         self.name = name
@@ -21,103 +27,714 @@ class FamilyMember:
 
 
 class Male(FamilyMember):
+    __slots__ = ()
 
     def __init__(self, name, mother=None, father=None):
         super().__init__(name, "male", mother, father)
 
 
 class Female(FamilyMember):
+    __slots__ = ()
 
     def __init__(self, name, mother=None, father=None):
         super().__init__(name, "female", mother, father)
 
 
-def create_paternal_inheritance_cpt(person, signature):
+class InheritanceModel:
+    """The genetics of a trait at a single locus, compiled into the CPT
+    templates used by create_family_bayes_net.
+
+    The model is held as tensors over allele and genotype indices: the
+    transmission matrix of each sex (the probability of passing on each
+    allele, given the parent's genotype, mutation included), the formation
+    tensor (the genotype made of a paternal and a maternal allele) and the
+    penetrance of each genotype. The CPTs of every person are slices of
+    these, shared through FactorTemplates.
+
+    Parameters
+    ----------
+    alleles : list[str]
+        The alleles of the locus. The first is the normal allele; any of the
+        others causes the trait.
+    frequencies : list[float], optional
+        The frequency of each allele among founders. By default each disease
+        allele has frequency 0.001 and the normal allele the rest.
+    x_linked : bool
+        Whether the locus is on the X chromosome, in which case males carry
+        a single allele (with genotypes such as 'Xy') and pass the Y
+        chromosome to their sons. Otherwise the locus is autosomal.
+    dominant : bool
+        Whether a single disease allele causes the trait. Otherwise two are
+        needed (or one, in a hemizygous male).
+    penetrance : float
+        The probability that a person with a causal genotype has the trait.
+    phenocopy : float
+        The probability that a person without one has it anyway.
+    mutation_rate : float
+        The probability that a transmitted allele mutates, into any of the
+        other alleles with equal probability.
+    """
+
+    def __init__(self, alleles, frequencies=None, x_linked=False, dominant=False,
+                 penetrance=1.0, phenocopy=0.0, mutation_rate=0.0):
+        self.alleles = list(alleles)
+        num_alleles = len(self.alleles)
+        if frequencies is None:
+            frequencies = [1.0 - 0.001 * (num_alleles - 1)] + [0.001] * (num_alleles - 1)
+        if len(frequencies) != num_alleles:
+            raise ValueError('Expected {} allele frequencies, got {}'.format(num_alleles, len(frequencies)))
+        self.frequencies = np.array(frequencies, dtype=float)
+        self.x_linked = x_linked
+        self.dominant = dominant
+        self.penetrance = penetrance
+        self.phenocopy = phenocopy
+        self.mutation_rate = mutation_rate
+
+        separator = '' if all(len(allele) == 1 for allele in self.alleles) else '/'
+        pairs = [(a, b) for a in range(num_alleles) for b in range(a, num_alleles)]
+        pair_index = np.zeros((num_alleles, num_alleles), dtype=int)
+        diploid_counts = np.zeros((len(pairs), num_alleles))
+        for index, (a, b) in enumerate(pairs):
+            pair_index[a, b] = pair_index[b, a] = index
+            diploid_counts[index, a] += 1
+            diploid_counts[index, b] += 1
+        diploid = [self.alleles[a] + separator + self.alleles[b] for a, b in pairs]
+        self.formation = np.zeros((num_alleles, num_alleles, len(pairs)))
+        paternal, maternal = np.indices((num_alleles, num_alleles))
+        self.formation[paternal, maternal, pair_index] = 1.0
+
+        if num_alleles > 1:
+            mutation = np.full((num_alleles, num_alleles), mutation_rate / (num_alleles - 1))
+            np.fill_diagonal(mutation, 1.0 - mutation_rate)
+        else:
+            mutation = np.ones((1, 1))
+        self.genotypes = {'female': diploid}
+        counts = {'female': diploid_counts}
+        if x_linked:
+            self.genotypes['male'] = [allele + separator + 'y' for allele in self.alleles]
+            counts['male'] = np.eye(num_alleles)
+        else:
+            self.genotypes['male'] = diploid
+            counts['male'] = diploid_counts
+        self.transmission = {sex: counts[sex] / counts[sex].sum(axis=1, keepdims=True) @ mutation
+                             for sex in counts}
+        self.penetrance_table = dict()
+        for sex, sex_counts in counts.items():
+            causal = sex_counts[:, 1:].sum(axis=1)
+            needed = 1 if dominant or sex_counts.sum(axis=1)[0] == 1 else 2
+            self.penetrance_table[sex] = np.where(causal >= needed, penetrance, phenocopy)
+
+        alleles, phenotypes = self.alleles, ['-', '+']
+        self.founder_allele = FactorTemplate.from_table([alleles], self.frequencies)
+        self.founder_y = FactorTemplate.from_table([['y']], [1.0])
+        self.mother_to_child = FactorTemplate.from_table([diploid, alleles], self.transmission['female'])
+        self.female_genotype = FactorTemplate.from_table([alleles, alleles, diploid], self.formation)
+        if x_linked:
+            males = self.genotypes['male']
+            self.father_to_son = FactorTemplate.from_table([males, ['y']], np.ones((num_alleles, 1)))
+            self.father_to_daughter = FactorTemplate.from_table([males, alleles], self.transmission['male'])
+            self.male_genotype = FactorTemplate.from_table([alleles, males], np.eye(num_alleles))
+        else:
+            self.father_to_son = self.father_to_daughter = self.mother_to_child
+            self.male_genotype = self.female_genotype
+        self.male_phenotype, self.female_phenotype = [
+            FactorTemplate.from_table([self.genotypes[sex], phenotypes],
+                                      np.stack([1.0 - self.penetrance_table[sex],
+                                                self.penetrance_table[sex]], axis=1))
+            for sex in ['male', 'female']]
+
+    def __repr__(self):
+        return (f'InheritanceModel({self.alleles}, frequencies={self.frequencies.tolist()}, '
+                f'x_linked={self.x_linked}, dominant={self.dominant}, '
+                f'penetrance={self.penetrance}, phenocopy={self.phenocopy}, '
+                f'mutation_rate={self.mutation_rate})')
+
+
+X_LINKED_RECESSIVE = InheritanceModel(['x', 'X'], x_linked=True)
+AUTOSOMAL_RECESSIVE = InheritanceModel(['a', 'A'])
+AUTOSOMAL_DOMINANT = InheritanceModel(['a', 'A'], dominant=True)
+
+
+def create_paternal_inheritance_cpt(person, signature, model=X_LINKED_RECESSIVE):
     inherited = signature[f'IP_{person.get_name()}']
     if person.father is not None:
         parent_genotype = signature[f'G_{person.father.get_name()}']
         if person.get_sex() == "male":
-            probs = {('xy', 'y'): 1.0, ('Xy', 'y'): 1.0}
-        else:
-            probs = {('xy', 'x'): 1.0, ('xy', 'X'): 0.0,
-                     ('Xy', 'x'): 0.0, ('Xy', 'X'): 1.0}
-        cpt = Factor([parent_genotype, inherited], probs)
-    else:
-        if person.get_sex() == "male":
-            probs = {('y',): 1.0}
-        else:
-            probs = {('x',): 0.999, ('X',): 0.001}
-        cpt = Factor([inherited], probs)
-    return cpt
+            return model.father_to_son.bind([parent_genotype, inherited])
+        return model.father_to_daughter.bind([parent_genotype, inherited])
+    if person.get_sex() == "male" and model.x_linked:
+        return model.founder_y.bind([inherited])
+    return model.founder_allele.bind([inherited])
 
 
-def create_maternal_inheritance_cpt(person, signature):
+def create_maternal_inheritance_cpt(person, signature, model=X_LINKED_RECESSIVE):
     inherited = signature[f'IM_{person.get_name()}']
     if person.mother is not None:
         parent_genotype = signature[f'G_{person.mother.get_name()}']
-        probs = {('xx', 'x'): 1.0, ('xx', 'X'): 0.0,
-                 ('xX', 'x'): 0.5, ('xX', 'X'): 0.5,
-                 ('XX', 'x'): 0.0, ('XX', 'X'): 1.0}
-        cpt = Factor([parent_genotype, inherited], probs)
-    else:
-        probs = {('x',): 0.999, ('X',): 0.001}
-        cpt = Factor([inherited], probs)
-    return cpt
+        return model.mother_to_child.bind([parent_genotype, inherited])
+    return model.founder_allele.bind([inherited])
 
 
-def create_genotype_cpt(person, signature):
+def create_genotype_cpt(person, signature, model=X_LINKED_RECESSIVE):
     maternal = signature[f'IM_{person.get_name()}']
     genotype = signature[f'G_{person.get_name()}']
-    if person.get_sex() == "male":
-        probs = {('x', 'xy'): 1.0, ('x', 'Xy'): 0.0,
-                 ('X', 'xy'): 0.0, ('X', 'Xy'): 1.0}
-        cpt = Factor([maternal, genotype], probs)
-    else:
-        paternal = signature[f'IP_{person.get_name()}']
-        probs = {('x', 'x', 'xx'): 1.0, ('x', 'x', 'xX'): 0.0, ('x', 'x', 'XX'): 0.0,
-                 ('x', 'X', 'xx'): 0.0, ('x', 'X', 'xX'): 1.0, ('x', 'X', 'XX'): 0.0,
-                 ('X', 'x', 'xx'): 0.0, ('X', 'x', 'xX'): 1.0, ('X', 'x', 'XX'): 0.0,
-                 ('X', 'X', 'xx'): 0.0, ('X', 'X', 'xX'): 0.0, ('X', 'X', 'XX'): 1.0}
-        cpt = Factor([paternal, maternal, genotype], probs)
-    return cpt
-
-
-def create_phenotype_cpt(person, signature):
+    if person.get_sex() == "male" and model.x_linked:
+        return model.male_genotype.bind([maternal, genotype])
+    paternal = signature[f'IP_{person.get_name()}']
+    return model.female_genotype.bind([paternal, maternal, genotype])
+
+
+def create_phenotype_cpt(person, signature, model=X_LINKED_RECESSIVE):
     genotype = signature[f'G_{person.get_name()}']
     phenotype = signature[f'P_{person.get_name()}']
     if person.get_sex() == "male":
-        probs = {('xy', '-'): 1.0, ('xy', '+'): 0.0,
-                 ('Xy', '-'): 0.0, ('Xy', '+'): 1.0}
-    else:
-        probs = {('xx', '-'): 1.0, ('xx', '+'): 0.0,
-                 ('xX', '-'): 1.0, ('xX', '+'): 0.0,
-                 ('XX', '-'): 0.0, ('XX', '+'): 1.0}
-    return Factor([genotype, phenotype], probs)
+        return model.male_phenotype.bind([genotype, phenotype])
+    return model.female_phenotype.bind([genotype, phenotype])
+
 
+def create_family_bayes_net(family, model=None):
+    """Builds the Bayesian network of a family under an InheritanceModel
+    (by default X_LINKED_RECESSIVE, as for hemophilia).
 
-def create_family_bayes_net(family):
+    Each person has a genotype G_, a phenotype P_ and the alleles inherited
+    from their mother (IM_) and, unless the locus is X-linked and the person
+    male, from their father (IP_).
+    """
+    if model is None:
+        model = X_LINKED_RECESSIVE
     variables = []
     for member in family:
-        if member.get_sex() == "male":
-            maternal_inheritance = Variable(f'IM_{member.name}', ['x', 'X'])
-            genotype = Variable(f'G_{member.name}', ['xy', 'Xy'])
-            phenotype = Variable(f'P_{member.name}', ['-', '+'])
-            variables = variables + [maternal_inheritance, genotype, phenotype]
-        else:
-            paternal_inheritance = Variable(f'IP_{member.name}', ['x', 'X'])
-            maternal_inheritance = Variable(f'IM_{member.name}', ['x', 'X'])
-            genotype = Variable(f'G_{member.name}', ['xx', 'xX', 'XX'])
-            phenotype = Variable(f'P_{member.name}', ['-', '+'])
-            variables = variables + [paternal_inheritance, maternal_inheritance,
-                                     genotype, phenotype]
+        sex = member.get_sex()
+        if sex == "female" or not model.x_linked:
+            variables.append(Variable(f'IP_{member.name}', model.alleles))
+        variables.extend([Variable(f'IM_{member.name}', model.alleles),
+                          Variable(f'G_{member.name}', model.genotypes[sex]),
+                          Variable(f'P_{member.name}', ['-', '+'])])
     signature = {var.get_name(): var for var in variables}
     cpts = []
     for person in family:
-        if person.get_sex() == "female":
-            cpts.append(create_paternal_inheritance_cpt(person, signature))
-        cpts.append(create_maternal_inheritance_cpt(person, signature))
-        cpts.append(create_genotype_cpt(person, signature))
-        cpts.append(create_phenotype_cpt(person, signature))
+        if person.get_sex() == "female" or not model.x_linked:
+            cpts.append(create_paternal_inheritance_cpt(person, signature, model))
+        cpts.append(create_maternal_inheritance_cpt(person, signature, model))
+        cpts.append(create_genotype_cpt(person, signature, model))
+        cpts.append(create_phenotype_cpt(person, signature, model))
     return BayesianNetwork(cpts)
 
 
+def pedigree_hash(family, model=None):
+    """Returns a hex digest identifying a pedigree (its members, in order,
+    with their sexes and parents) and the inheritance model, if it is not
+    the default one."""
+    digest = hashlib.sha256()
+    for member in family:
+        mother = member.mother.get_name() if member.mother is not None else ''
+        father = member.father.get_name() if member.father is not None else ''
+        digest.update(f'{member.get_name()},{member.get_sex()},{mother},{father}\n'.encode())
+    if model is not None and repr(model) != repr(X_LINKED_RECESSIVE):
+        digest.update(repr(model).encode())
+    return digest.hexdigest()
+
+
+def compile_family_junction_tree(family, cache_dir=None, model=None):
+    """Builds the junction tree of a family's Bayesian network.
+
+    If cache_dir is given, compiled trees are stored there under the hash of
+    the pedigree and model, and a tree compiled earlier for the same
+    pedigree and model is loaded instead of being rebuilt. Trees are written
+    to a temporary file first and then moved into place, so concurrent jobs
+    sharing the cache never load a partly written file.
+    """
+    if cache_dir is None:
+        return build_junction_tree_for_bayes_net(create_family_bayes_net(family, model))
+    path = os.path.join(cache_dir, f'{pedigree_hash(family, model)}.npz')
+    if os.path.exists(path):
+        return load_junction_tree(path)
+    junction_tree = build_junction_tree_for_bayes_net(create_family_bayes_net(family, model))
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            save_junction_tree(junction_tree, f)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return junction_tree
+
+
+MISSING_IDS = {'', '0', '.', 'NA'}
+SEX_CODES = {'1': 'male', 'm': 'male', 'male': 'male',
+             '2': 'female', 'f': 'female', 'female': 'female'}
+PHENOTYPE_CODES = {'1': '-', '-': '-', 'unaffected': '-',
+                   '2': '+', '+': '+', 'affected': '+'}
+
+
+def read_pedigree_records(path, chunk_size=10000):
+    """Streams the records of a pedigree file, in lists of up to chunk_size.
+
+    Files ending in .ped are read as PED files (whitespace-separated family,
+    id, father, mother, sex and phenotype columns); anything else as CSV
+    with a header naming id, sex, mother and father columns and optionally a
+    phenotype column. CSV records have an empty family.
+
+    Yields
+    ------
+    list[(str, str, str, str, str, str)]
+        (family, id, sex, mother, father, phenotype) records, as raw strings.
+    """
+
+    with open(path, newline='') as f:
+        if path.lower().endswith('.ped'):
+            records = _ped_records(path, f)
+        else:
+            records = _csv_records(path, f)
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+
+def _ped_records(path, f):
+    """Parses the lines of a PED file into records (see read_pedigree_records)."""
+    for line_number, line in enumerate(f, start=1):
+        row = line.split()
+        if len(row) == 0 or row[0].startswith('#'):
+            continue
+        if len(row) < 5:
+            raise ValueError('{}, line {}: expected at least 5 fields, got {}'.format(
+                path, line_number, len(row)))
+        yield row[0], row[1], row[4], row[3], row[2], row[5] if len(row) > 5 else '0'
+
+
+def _csv_records(path, f):
+    """Parses the rows of a pedigree CSV file into records (see
+    read_pedigree_records)."""
+    reader = csv.reader(f)
+    header = [column.strip().lower() for column in next(reader)]
+    missing = [c for c in ['id', 'sex', 'mother', 'father'] if c not in header]
+    if len(missing) > 0:
+        raise ValueError('{}: missing pedigree columns: {}'.format(path, ', '.join(missing)))
+    columns = [header.index(c) for c in ['id', 'sex', 'mother', 'father']]
+    phenotype = header.index('phenotype') if 'phenotype' in header else None
+    for row in reader:
+        if len(row) == 0:
+            continue
+        if len(row) < len(header):
+            raise ValueError('{}, line {}: expected {} fields, got {}'.format(
+                path, reader.line_num, len(header), len(row)))
+        yield (('',) + tuple(row[c].strip() for c in columns) +
+               (row[phenotype].strip() if phenotype is not None else '',))
+
+
+class PedigreeReport:
+    """Summarizes the problems load_pedigree found (and worked around) in a
+    pedigree file."""
+
+    def __init__(self, num_members, duplicates, orphans, sex_conflicts, cycles, unknown_sex):
+        self.num_members = num_members
+        self.duplicates = duplicates
+        self.orphans = orphans
+        self.sex_conflicts = sex_conflicts
+        self.cycles = cycles
+        self.unknown_sex = unknown_sex
+
+    def is_clean(self):
+        """Checks whether no problem was found."""
+        return (len(self.duplicates) + len(self.orphans) + len(self.sex_conflicts)
+                + len(self.cycles) + len(self.unknown_sex)) == 0
+
+    def __str__(self):
+        return (f"loaded {self.num_members} members; {len(self.duplicates)} duplicate ids and "
+                f"{len(self.unknown_sex)} people of unknown sex skipped, "
+                f"{len(self.orphans)} references to unknown parents, "
+                f"{len(self.sex_conflicts)} parents of the wrong sex and "
+                f"{len(self.cycles)} cyclic references dropped")
+
+
+def load_pedigree(path, chunk_size=10000, strict=False):
+    """Loads a pedigree file (see read_pedigree_records) into FamilyMembers.
+
+    The file is streamed in chunks and parents are resolved through an index
+    from ids to members, so each person is held once, however the file is
+    ordered. PED ids are only unique within a family, so members are keyed
+    by family and id, parents are looked up in the child's family, and
+    members are named family_id (e.g. F1_1). Problem records are dropped and
+    reported: repeated ids (the first record wins), people of unknown sex
+    (whose children then have an unknown parent), parents that never
+    appear, mothers recorded as male or fathers as female, and references
+    that would make someone their own ancestor.
+
+    Parameters
+    ----------
+    path : str
+        The pedigree file.
+    chunk_size : int
+        The number of records read at a time.
+    strict : bool
+        If set, raise ValueError instead of dropping problem records.
+
+    Returns
+    -------
+    (list[FamilyMember], dict[str, str], PedigreeReport)
+        The members in file order, the phenotype evidence (keyed by P_
+        variable names, for create_family_bayes_net) and the report.
+    """
+
+    members = dict()
+    evidence = dict()
+    pending = []
+    duplicates = []
+    unknown_sex = []
+    for chunk in read_pedigree_records(path, chunk_size):
+        for family, person, sex, mother, father, phenotype in chunk:
+            name = f'{family}_{person}' if family != '' else person
+            if (family, person) in members:
+                duplicates.append(name)
+                continue
+            if sex.lower() not in SEX_CODES:
+                if strict:
+                    raise ValueError('Unknown sex {!r} for {}'.format(sex, name))
+                unknown_sex.append(name)
+                continue
+            member = Male(name) if SEX_CODES[sex.lower()] == 'male' else Female(name)
+            members[(family, person)] = member
+            if mother not in MISSING_IDS or father not in MISSING_IDS:
+                pending.append((family, member, mother, father))
+            if phenotype.lower() in PHENOTYPE_CODES:
+                evidence[f'P_{name}'] = PHENOTYPE_CODES[phenotype.lower()]
+    orphans = []
+    sex_conflicts = []
+    for family, member, mother, father in pending:
+        for parent_id, sex in [(mother, 'female'), (father, 'male')]:
+            if parent_id in MISSING_IDS:
+                continue
+            parent = members.get((family, parent_id))
+            parent_name = f'{family}_{parent_id}' if family != '' else parent_id
+            if parent is None:
+                orphans.append((member.get_name(), parent_name))
+            elif parent.get_sex() != sex:
+                sex_conflicts.append((member.get_name(), parent_name))
+            elif sex == 'female':
+                member.mother = parent
+            else:
+                member.father = parent
+    cycles = break_pedigree_cycles(members.values())
+    report = PedigreeReport(len(members), duplicates, orphans, sex_conflicts, cycles,
+                            unknown_sex)
+    if strict and not report.is_clean():
+        raise ValueError(str(report))
+    return list(members.values()), evidence, report
+
+
+def break_pedigree_cycles(family):
+    """Finds people recorded as their own ancestors, by depth-first search
+    over parent links, and drops the link that closes each cycle. Returns
+    the dropped (child, parent) name pairs."""
+    visiting, done = 1, 2
+    state = dict()
+    dropped = []
+    for start in family:
+        if start.get_name() in state:
+            continue
+        state[start.get_name()] = visiting
+        stack = [(start, ['father', 'mother'])]
+        while len(stack) > 0:
+            member, links = stack[-1]
+            if len(links) == 0:
+                state[member.get_name()] = done
+                stack.pop()
+                continue
+            link = links.pop()
+            parent = getattr(member, link)
+            if parent is None:
+                continue
+            if state.get(parent.get_name()) == visiting:
+                setattr(member, link, None)
+                dropped.append((member.get_name(), parent.get_name()))
+            elif parent.get_name() not in state:
+                state[parent.get_name()] = visiting
+                stack.append((parent, ['father', 'mother']))
+    return dropped
+
+
+class PeelingEngine:
+    """Computes genotype posteriors by peeling.
+
+    Rather than building generic variables for each person, this works on
+    the pedigree itself: people and nuclear families (the children of one
+    mother and father) form a bipartite graph, and each nuclear family
+    carries the transmission from its parents to its children.
+    For a loop-free pedigree that graph is a forest, so one collect and one
+    distribute pass of messages over it give every posterior, in time
+    linear in the size of the pedigree. A family's message to one member
+    combines the others through prefix and suffix products over its
+    children, so large sibships cost no more than linear time either.
+
+    The transmission, genotype and penetrance tables are read from the CPT
+    templates of an InheritanceModel (by default X_LINKED_RECESSIVE), so the
+    posteriors are those of create_family_bayes_net under the same model.
+    allele_frequency, if given, overrides the frequency of the disease
+    allele of a two-allele model. A parent missing from the family is
+    treated like a founder.
+    """
+
+    def __init__(self, family, allele_frequency=None, model=None):
+        self.model = X_LINKED_RECESSIVE if model is None else model
+        if allele_frequency is None:
+            self.allele_prior = self.model.founder_allele.dense_table()
+        elif len(self.model.alleles) == 2:
+            self.allele_prior = np.array([1.0 - allele_frequency, allele_frequency])
+        else:
+            raise ValueError('allele_frequency needs a two-allele model, not one with '
+                             '{} alleles'.format(len(self.model.alleles)))
+        # For a child of each sex: what its father passes on, what a missing
+        # father is taken to pass on, and the genotype it forms from its
+        # paternal and maternal alleles.
+        if self.model.x_linked:
+            self.father_passes = {'male': self.model.father_to_son.dense_table(),
+                                  'female': self.model.father_to_daughter.dense_table()}
+            self.founder_father_passes = {'male': self.model.founder_y.dense_table(),
+                                          'female': self.allele_prior}
+            self.formation = {'male': self.model.male_genotype.dense_table()[None],
+                              'female': self.model.female_genotype.dense_table()}
+        else:
+            self.father_passes = {sex: self.model.father_to_daughter.dense_table()
+                                  for sex in ['male', 'female']}
+            self.founder_father_passes = {sex: self.allele_prior for sex in ['male', 'female']}
+            self.formation = {sex: self.model.female_genotype.dense_table()
+                              for sex in ['male', 'female']}
+        self.members = {member.get_name(): member for member in family}
+        self.nuclear_families = dict()
+        for member in self.members.values():
+            mother, father = self.parent_name(member.mother), self.parent_name(member.father)
+            if mother is not None or father is not None:
+                self.nuclear_families.setdefault((mother, father), []).append(member.get_name())
+        self.neighbors = {('person', name): [] for name in self.members}
+        for key, children in self.nuclear_families.items():
+            node = ('family', key)
+            self.neighbors[node] = [('person', name) for name in key if name is not None]
+            self.neighbors[node] += [('person', name) for name in children]
+            for person in self.neighbors[node]:
+                self.neighbors[person].append(node)
+        self.schedule = self.build_schedule()
+        self.potentials = None
+        self.messages = None
+        self.log_likelihood = None
+
+    def parent_name(self, parent):
+        if parent is None or parent.get_name() not in self.members:
+            return None
+        return parent.get_name()
+
+    def build_schedule(self):
+        """Returns the collect edges (towards a root in each component, in
+        reverse breadth-first order) and raises ValueError if the pedigree
+        has a loop."""
+        collect = []
+        visited = set()
+        for root in self.neighbors:
+            if root in visited:
+                continue
+            visited.add(root)
+            parents = {root: None}
+            queue = deque([root])
+            while len(queue) > 0:
+                node = queue.popleft()
+                for neighbor in self.neighbors[node]:
+                    if neighbor == parents[node]:
+                        continue
+                    if neighbor in visited:
+                        raise ValueError('The pedigree has a loop through {}; peeling '
+                                         'requires a loop-free pedigree'.format(neighbor[1]))
+                    visited.add(neighbor)
+                    parents[neighbor] = node
+                    collect.append((neighbor, node))
+                    queue.append(neighbor)
+        return collect[::-1]
+
+    def run(self, evidence):
+        """Propagates evidence on the phenotypes (P_ names) and genotypes
+        (G_ names) of the family members."""
+        self.potentials = {name: self.person_potential(member)
+                           for name, member in self.members.items()}
+        for key, value in evidence.items():
+            kind, _, name = key.partition('_')
+            if name not in self.members or kind not in ['P', 'G']:
+                raise ValueError('Unsupported evidence variable: {}'.format(key))
+            sex = self.members[name].get_sex()
+            if kind == 'P':
+                phenotype = self.model.male_phenotype if sex == 'male' else self.model.female_phenotype
+                table = phenotype.dense_table()
+                likelihood = (table[:, ['-', '+'].index(value)] if value in ['-', '+']
+                              else np.zeros(len(table)))
+            else:
+                likelihood = np.array([float(value == g) for g in self.model.genotypes[sex]])
+            self.potentials[name] = self.potentials[name] * likelihood
+        self.messages = dict()
+        self.log_likelihood = 0.0
+        for (src, dest) in self.schedule:
+            self.log_likelihood += self.send(src, [dest])
+        for root in set(self.neighbors) - {src for (src, _) in self.schedule}:
+            total = self.belief(root).sum() if root[0] == 'person' else 1.0
+            self.log_likelihood += np.log(total) if total > 0 else -np.inf
+        outgoing = defaultdict(list)
+        for (dest, src) in self.schedule:
+            outgoing[src].append(dest)
+        for (dest, src) in self.schedule[::-1]:
+            if src in outgoing:
+                self.send(src, outgoing.pop(src))
+
+    def person_potential(self, member):
+        """Returns the prior of a founder's genotype (ones for anyone else,
+        whose genotype is governed by their nuclear family)."""
+        mother, father = self.parent_name(member.mother), self.parent_name(member.father)
+        sex = member.get_sex()
+        if mother is not None or father is not None:
+            return np.ones(len(self.model.genotypes[sex]))
+        return np.einsum('b,a,bac->c', self.founder_father_passes[sex], self.allele_prior,
+                         self.formation[sex])
+
+    def send(self, src, dests):
+        """Computes and stores normalized messages from a node to some of its
+        neighbors, returning the log of the normalizing constants."""
+        if src[0] == 'person':
+            messages = {dest: self.belief(src, exclude=dest) for dest in dests}
+        else:
+            messages = self.family_messages(src[1], [dest[1] for dest in dests])
+            messages = {('person', name): message for name, message in messages.items()}
+        log_total = 0.0
+        for dest, message in messages.items():
+            total = message.sum()
+            self.messages[(src, dest)] = message / total if total > 0 else message
+            log_total += np.log(total) if total > 0 else -np.inf
+        return log_total
+
+    def belief(self, person, exclude=None):
+        """Returns a person's potential times the messages from their
+        nuclear families (except `exclude`)."""
+        result = self.potentials[person[1]]
+        for neighbor in self.neighbors[person]:
+            if neighbor != exclude:
+                result = result * self.messages[(neighbor, person)]
+        return result
+
+    def family_messages(self, key, dests):
+        """Computes the messages from a nuclear family to some of its members
+        (given the messages from all the others)."""
+        mother, father = key
+        children = self.nuclear_families[key]
+        node = ('family', key)
+        mother_allele = (self.model.mother_to_child.dense_table() if mother is not None
+                         else self.allele_prior[None, :])
+        transmissions = dict()
+        for sex in ['male', 'female']:
+            father_allele = (self.father_passes[sex] if father is not None
+                             else self.founder_father_passes[sex][None, :])
+            transmissions[sex] = np.einsum('ma,fb,bac->mfc', mother_allele, father_allele,
+                                           self.formation[sex])
+        shape = transmissions['female'].shape[:2]
+
+        def transmission(child):
+            return transmissions[self.members[child].get_sex()]
+
+        def incoming(name, size):
+            if name is None or (('person', name), node) not in self.messages:
+                return np.ones(size)
+            return self.messages[(('person', name), node)]
+
+        # likelihoods[i] sums child i's genotype out of its message, as a
+        # table over the parents' genotypes; prefix[i] and suffix[i] hold
+        # the products of the likelihoods before and from child i.
+        likelihoods = [transmission(child) @ incoming(child, transmission(child).shape[-1])
+                       for child in children]
+        prefix, suffix = [np.ones(shape)], [np.ones(shape)]
+        for likelihood in likelihoods:
+            prefix.append(prefix[-1] * likelihood)
+        for likelihood in likelihoods[::-1]:
+            suffix.append(suffix[-1] * likelihood)
+        suffix = suffix[::-1]
+        mother_message, father_message = incoming(mother, shape[0]), incoming(father, shape[1])
+        positions = {child: i for i, child in enumerate(children)}
+        messages = dict()
+        for dest in dests:
+            if dest == mother:
+                messages[dest] = prefix[-1] @ father_message
+            elif dest == father:
+                messages[dest] = mother_message @ prefix[-1]
+            else:
+                i = positions[dest]
+                messages[dest] = np.einsum('m,f,mf,mfc->c', mother_message, father_message,
+                                           prefix[i] * suffix[i + 1], transmission(dest))
+        return messages
+
+    def get_marginals(self):
+        """Returns the posterior of each member's genotype, keyed by the name
+        of its G_ variable (as in BeliefPropagation.get_marginals)."""
+        marginals = dict()
+        for name, member in self.members.items():
+            belief = self.belief(('person', name))
+            total = belief.sum()
+            variable = Variable(f'G_{name}', self.model.genotypes[member.get_sex()])
+            marginals[f'G_{name}'] = DenseFactor([variable], belief / total if total > 0 else belief)
+        return marginals
+
+
+class AlleleFrequencySweep:
+    """Genotype posteriors of a family over a grid of founder allele
+    frequencies.
+
+    The junction tree is compiled once, with the founders' allele priors
+    left as a slot of a BatchBeliefPropagation, and each grid point is one
+    case of the batch, so a whole grid is evaluated in a single vectorized
+    propagation instead of one network and tree per value.
+    """
+
+    def __init__(self, family, model=None, cache_dir=None):
+        self.model = X_LINKED_RECESSIVE if model is None else model
+        self.junction_tree = compile_family_junction_tree(family, cache_dir, model)
+        founders = [f'IM_{member.get_name()}' for member in family if member.mother is None]
+        founders += [f'IP_{member.get_name()}' for member in family
+                     if member.father is None and (member.get_sex() == "female" or not self.model.x_linked)]
+        self.genotypes = [f'G_{member.get_name()}' for member in family]
+        self.propagation = BatchBeliefPropagation(self.junction_tree, slots={'founder_allele': founders})
+
+    def founder_priors(self, frequencies):
+        """Turns a grid of frequencies into an array of founder priors, one
+        row per grid point. A 1-d grid gives the frequency of the disease
+        allele of a two-allele model; a 2-d grid gives the frequency of
+        every allele."""
+        frequencies = np.asarray(frequencies, dtype=float)
+        if frequencies.ndim == 1:
+            if len(self.model.alleles) != 2:
+                raise ValueError('Give one row of frequencies per grid point for models '
+                                 'with {} alleles'.format(len(self.model.alleles)))
+            return np.stack([1.0 - frequencies, frequencies], axis=1)
+        if frequencies.ndim != 2 or frequencies.shape[1] != len(self.model.alleles):
+            raise ValueError('Expected a grid of shape (points, {}), got {}'.format(
+                len(self.model.alleles), frequencies.shape))
+        return frequencies
+
+    def run(self, frequencies, evidence=None):
+        """Computes the genotype posteriors at every point of a frequency grid.
+
+        Parameters
+        ----------
+        frequencies : numpy.ndarray
+            The grid (see founder_priors).
+        evidence : dict[str, str], optional
+            The evidence, the same at every grid point.
+
+        Returns
+        -------
+        dict[str, numpy.ndarray]
+            For each G_ variable, an array of shape (points, genotypes)
+            whose rows are the posteriors at each grid point.
+        """
+        priors = self.founder_priors(frequencies)
+        evidence = dict() if evidence is None else evidence
+        self.propagation.run([evidence] * len(priors), {'founder_allele': priors})
+        return self.propagation.get_marginals(self.genotypes)
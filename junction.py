@@ -1,7 +1,13 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import os
 import numpy as np
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import minimum_spanning_tree
-from factor import multiply
+from factor import Factor, DenseFactor, SparseFactor, FactorTemplate, TemplateFactor, Variable
+from factor import align_table, contract, divide, multiply_dense
+from factor import multiply_marginalize, multiply_maximize
 from elimination import min_degree_elim_order
 from bayes import UndirectedGraph
 
@@ -9,38 +15,214 @@ from bayes import UndirectedGraph
 def build_junction_tree(moral_graph, elim_order):
     def elimination_cliques():
         result = []
-        adjacencies = moral_graph.adjacency
+        adjacencies = {node: set(neighbors) for node, neighbors in moral_graph.adjacency.items()}
         for node in elim_order:
-            result.append(adjacencies[node] | {node})
-            neighbors = adjacencies[node]
-            new_adjacencies = dict()
-            for n in adjacencies:
-                if n in neighbors:
-                    new_adjacencies[n] = (adjacencies[n] - {node}) | (neighbors - {n})
-                elif n != node:
-                    new_adjacencies[n] = adjacencies[n]
-            adjacencies = new_adjacencies
+            neighbors = adjacencies.pop(node)
+            result.append(neighbors | {node})
+            for n in neighbors:
+                adjacencies[n].discard(node)
+                adjacencies[n] |= neighbors - {n}
         return result
-    cliques = elimination_cliques()
-    adjacency_matrix = np.zeros((len(cliques), len(cliques)), int)
-    for i in range(len(cliques)):
-        for j in range(i+1, len(cliques)):
-            adjacency_matrix[i][j] = -len(cliques[i] & cliques[j])
+
+    def maximal_cliques(cliques):
+        # An elimination clique can only be contained in a clique created
+        # earlier, since it holds a variable that later cliques lack.
+        result = []
+        index = defaultdict(set)
+        for clique in cliques:
+            holders = sorted((index[var] for var in clique), key=len)
+            if len(set.intersection(*holders)) > 0:
+                continue
+            for var in clique:
+                index[var].add(len(result))
+            result.append(clique)
+        return result, index
+
+    cliques, index = maximal_cliques(elimination_cliques())
+    candidates = set()
+    for holders in index.values():
+        holders = sorted(holders)
+        for i, clique1 in enumerate(holders):
+            for clique2 in holders[i + 1:]:
+                candidates.add((clique1, clique2))
+    candidates = sorted(candidates)
+    weights = [-len(cliques[i] & cliques[j]) for (i, j) in candidates]
+    rows = [i for (i, _) in candidates]
+    cols = [j for (_, j) in candidates]
+    adjacency_matrix = csr_matrix((weights, (rows, cols)), shape=(len(cliques), len(cliques)))
     mst = minimum_spanning_tree(adjacency_matrix)
     edges = zip(mst.nonzero()[0], mst.nonzero()[1])
-    graph = UndirectedGraph(nodes=list(range(len(elim_order))), edges=edges)
+    graph = UndirectedGraph(nodes=list(range(len(cliques))), edges=edges)
     return JunctionTree(graph, cliques)
 
 
-def build_junction_tree_for_bayes_net(bnet):
+def build_junction_tree_for_bayes_net(bnet, heuristic=min_degree_elim_order,
+                                      query_vars=None, evidence=None):
+    """Compiles a junction tree for a Bayesian network.
+
+    If query_vars is given, the network is first pruned for that query and
+    evidence (see BayesianNetwork.prune), so the tree only covers the part of
+    the network the query depends on.
+    """
+    if query_vars is not None:
+        bnet, _ = bnet.prune(query_vars, evidence if evidence is not None else dict())
     moral_graph = bnet.moral_graph()
-    elim_order = min_degree_elim_order(moral_graph)
+    elim_order = heuristic(moral_graph, bnet.domain_sizes())
     junction_tree = build_junction_tree(moral_graph, elim_order)
+    junction_tree.add_variables(bnet.get_variables())
     for factor in bnet.get_factors():
         junction_tree.add_factor(factor)
+    junction_tree.compile_potentials()
     return junction_tree
 
 
+def save_junction_tree(junction_tree, path):
+    """Writes a compiled junction tree to a compressed NumPy .npz file.
+
+    The file holds the variables and their domains, the clusters, the tree
+    edges, every assigned factor (as a flat table plus the mask of rows a
+    dict-based factor stores) and the 'center' message schedule, all as
+    plain arrays. Domain values must be strings. Factors bound from a
+    FactorTemplate are stored as a reference to one copy of the template's
+    table, and load_junction_tree binds them to a single shared template
+    again.
+
+    Parameters
+    ----------
+    junction_tree : JunctionTree
+        The tree to save.
+    path : str
+        Where to write the file.
+    """
+
+    names = sorted(junction_tree.variables)
+    ids = {name: i for i, name in enumerate(names)}
+    domains = [junction_tree.variables[name].get_domain() for name in names]
+    clusters = [sorted(ids[name] for name in cluster) for cluster in junction_tree.clusters]
+    factor_nodes, factor_kinds, factor_vars, tables, masks = [], [], [], [], []
+    template_ids, factor_templates, template_tables, template_masks = dict(), [], [], []
+    for node in junction_tree.graph.nodes:
+        for factor in junction_tree.factors[node]:
+            factor_nodes.append(node)
+            factor_vars.append([ids[var.get_name()] for var in factor.get_variables()])
+            if isinstance(factor, TemplateFactor):
+                template = factor.get_template()
+                if id(template) not in template_ids:
+                    template_ids[id(template)] = len(template_tables)
+                    template_tables.append(factor.to_dense().get_table().ravel())
+                    template_masks.append(factor.support_mask().ravel())
+                factor_kinds.append('template')
+                factor_templates.append(template_ids[id(template)])
+                tables.append(np.zeros(0))
+                masks.append(np.zeros(0, dtype=bool))
+                continue
+            factor_templates.append(-1)
+            if isinstance(factor, DenseFactor):
+                kind = 'log' if factor.is_log_domain() else 'dense'
+                mask = np.ones(factor.get_table().shape, dtype=bool)
+            else:
+                kind = 'sparse' if isinstance(factor, SparseFactor) else 'dict'
+                mask = factor.support_mask()
+            factor_kinds.append(kind)
+            tables.append(factor.get_table().ravel() if isinstance(factor, DenseFactor)
+                          else factor.to_dense().get_table().ravel())
+            masks.append(mask.ravel())
+    np.savez_compressed(
+        path,
+        variable_names=np.array(names, dtype=str),
+        domain_values=np.array([value for domain in domains for value in domain], dtype=str),
+        domain_offsets=np.cumsum([0] + [len(domain) for domain in domains]),
+        cluster_variables=np.array([i for cluster in clusters for i in cluster], dtype=int),
+        cluster_offsets=np.cumsum([0] + [len(cluster) for cluster in clusters]),
+        edges=np.array(junction_tree.graph.get_edges(), dtype=int).reshape(-1, 2),
+        schedule=np.array(junction_tree.init_message_queue(), dtype=int).reshape(-1, 2),
+        factor_nodes=np.array(factor_nodes, dtype=int),
+        factor_kinds=np.array(factor_kinds, dtype=str),
+        factor_variables=np.array([i for var_ids in factor_vars for i in var_ids], dtype=int),
+        factor_variable_offsets=np.cumsum([0] + [len(var_ids) for var_ids in factor_vars]),
+        factor_tables=np.concatenate(tables) if len(tables) > 0 else np.zeros(0),
+        factor_masks=np.concatenate(masks) if len(masks) > 0 else np.zeros(0, dtype=bool),
+        factor_table_offsets=np.cumsum([0] + [len(table) for table in tables]),
+        factor_templates=np.array(factor_templates, dtype=int),
+        template_tables=np.concatenate(template_tables) if len(template_tables) > 0 else np.zeros(0),
+        template_masks=(np.concatenate(template_masks) if len(template_masks) > 0
+                        else np.zeros(0, dtype=bool)),
+        template_table_offsets=np.cumsum([0] + [len(table) for table in template_tables]))
+
+
+def load_junction_tree(path):
+    """Reads a junction tree written by save_junction_tree.
+
+    Parameters
+    ----------
+    path : str
+        The file to read.
+
+    Returns
+    -------
+    JunctionTree
+        The compiled tree, with its factors already assigned and its message
+        schedule already built.
+    """
+
+    def segments(values, offsets):
+        return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    with np.load(path) as data:
+        names = [str(name) for name in data['variable_names']]
+        domains = segments([str(value) for value in data['domain_values']], data['domain_offsets'])
+        variables = [Variable(name, domain) for name, domain in zip(names, domains)]
+        clusters = [{names[i] for i in cluster}
+                    for cluster in segments(data['cluster_variables'], data['cluster_offsets'])]
+        graph = UndirectedGraph(nodes=list(range(len(clusters))),
+                                edges=[(int(a), int(b)) for (a, b) in data['edges']])
+        junction_tree = JunctionTree(graph, clusters)
+        junction_tree.add_variables(variables)
+        factor_vars = segments(data['factor_variables'], data['factor_variable_offsets'])
+        tables = segments(data['factor_tables'], data['factor_table_offsets'])
+        masks = segments(data['factor_masks'], data['factor_table_offsets'])
+        if 'factor_templates' in data:
+            factor_templates = data['factor_templates']
+            template_tables = segments(data['template_tables'], data['template_table_offsets'])
+            template_masks = segments(data['template_masks'], data['template_table_offsets'])
+        else:
+            factor_templates = np.full(len(data['factor_nodes']), -1)
+        templates = dict()
+        for node, kind, var_ids, table, mask, template in zip(
+                data['factor_nodes'], data['factor_kinds'], factor_vars, tables, masks,
+                factor_templates):
+            factor_variables = [variables[i] for i in var_ids]
+            shape = [len(var.get_domain()) for var in factor_variables]
+            if kind == 'template':
+                if template not in templates:
+                    templates[template] = load_template(
+                        [var.get_domain() for var in factor_variables],
+                        template_tables[template].reshape(shape),
+                        template_masks[template].reshape(shape))
+                junction_tree.assign_factor(templates[template].bind(factor_variables), int(node))
+                continue
+            table = table.reshape(shape)
+            if kind in ('dense', 'log'):
+                factor = DenseFactor(factor_variables, table, log_domain=(kind == 'log'))
+            else:
+                values = {tuple(int(i) for i in index): float(table[tuple(index)])
+                          for index in np.argwhere(mask.reshape(shape))}
+                factor_class = SparseFactor if kind == 'sparse' else Factor
+                factor = factor_class.from_codes(factor_variables, values)
+            junction_tree.assign_factor(factor, int(node))
+        junction_tree._schedules['center'] = [(int(src), int(dest)) for (src, dest) in data['schedule']]
+    return junction_tree
+
+
+def load_template(domains, table, mask):
+    """Rebuilds a FactorTemplate saved by save_junction_tree from its table
+    and the mask of the rows it stores."""
+    if mask.all():
+        return FactorTemplate.from_table(domains, table)
+    return FactorTemplate(domains, {tuple(domain[i] for domain, i in zip(domains, index)):
+                                    float(table[tuple(index)]) for index in np.argwhere(mask)})
+
+
 class JunctionTree:
 
     def __init__(self, graph, clusters):
@@ -54,24 +236,149 @@ class JunctionTree:
         self.factors = dict()
         for node in self.graph.nodes:
             self.factors[node] = []
+        self.variables = dict()
+        self._schedules = dict()
+        self._potentials = dict()
+
+    def add_variables(self, variables):
+        """Registers the Variables of the tree's clusters, so clique sizes are
+        known before any factor is assigned."""
+        for var in variables:
+            self.variables[var.get_name()] = var
 
     def add_factor(self, factor):
+        """Assigns a factor to the smallest clique (by table size) that covers
+        it, breaking ties in favor of the clique with the fewest factors. All
+        the variables of the candidate cliques must have been registered,
+        through add_variables or earlier factors."""
+        for var in factor.get_variables():
+            self.variables[var.get_name()] = var
         nodesets = [self.node_map[var.get_name()] for var in factor.get_variables()]
-        possible_assignments = nodesets[0]
+        possible_assignments = set(self.graph.nodes) if len(nodesets) == 0 else nodesets[0]
         for nodeset in nodesets[1:]:
             possible_assignments = possible_assignments & nodeset
-        assignment = list(possible_assignments)[0]
-        self.factors[assignment].append(factor)
+        assignment = min(possible_assignments,
+                         key=lambda node: (self.table_size(node), len(self.factors[node]), node))
+        self.assign_factor(factor, assignment)
+
+    def assign_factor(self, factor, node):
+        for var in factor.get_variables():
+            self.variables[var.get_name()] = var
+        self.factors[node].append(factor)
+        self._potentials.pop(node, None)
+
+    def get_potential(self, node):
+        """Returns the product of the factors assigned to a clique (None if
+        there are none). Products are computed once and cached."""
+        if node not in self._potentials:
+            if len(self.factors[node]) == 0:
+                self._potentials[node] = None
+            else:
+                self._potentials[node] = multiply_marginalize(self.factors[node],
+                                                              self.clusters[node])
+        return self._potentials[node]
+
+    def compile_potentials(self):
+        """Computes the potential of every clique ahead of inference."""
+        for node in self.graph.nodes:
+            self.get_potential(node)
+
+    def init_message_queue(self, root_strategy='center'):
+        """Returns the message schedule: a collect pass towards a root in each
+        connected component, then a distribute pass back out.
 
-    def init_message_queue(self):
+        The schedule is built in linear time and cached per root strategy:
+          - 'center' roots each component at a node of minimum eccentricity,
+            which minimizes the number of sequential rounds;
+          - 'centroid' roots it at the node minimizing the sum, over all
+            cliques, of table size times distance to the root.
+        """
+        if root_strategy not in self._schedules:
+            self._schedules[root_strategy] = self.build_schedule(root_strategy)
+        return self._schedules[root_strategy]
+
+    def build_schedule(self, root_strategy='center'):
         order = []
-        frontier = [(0, n) for n in self.graph.get_neighbors(0)]
-        while len(frontier) > 0:
-            (src, dest), frontier = frontier[0], frontier[1:]
-            frontier = frontier + [(dest, n) for n in self.graph.get_neighbors(dest) - {src}]
-            order.append((src, dest))
-        order = [(dest, src) for (src, dest) in order[::-1]] + order
-        return order
+        visited = set()
+        for node in self.graph.nodes:
+            if node in visited:
+                continue
+            component = self.breadth_first(node)
+            visited.update(component)
+            if root_strategy == 'center':
+                root = self.center(component)
+            elif root_strategy == 'centroid':
+                root = self.centroid(component)
+            else:
+                raise ValueError('Unknown root strategy: {}'.format(root_strategy))
+            order += self.tree_edges(root)
+        return [(dest, src) for (src, dest) in order[::-1]] + order
+
+    def breadth_first(self, root):
+        """Returns the nodes of root's component in breadth-first order."""
+        return [node for node, _ in self.breadth_first_parents(root)]
+
+    def breadth_first_parents(self, root):
+        """Returns (node, parent) pairs in breadth-first order from root."""
+        result = [(root, None)]
+        seen = {root}
+        queue = deque([root])
+        while len(queue) > 0:
+            node = queue.popleft()
+            for neighbor in self.graph.get_neighbors(node):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    result.append((neighbor, node))
+                    queue.append(neighbor)
+        return result
+
+    def tree_edges(self, root):
+        """Returns the (parent, child) edges of the tree rooted at root, in
+        breadth-first order."""
+        return [(parent, node) for node, parent in self.breadth_first_parents(root)[1:]]
+
+    def center(self, component):
+        """Returns a node of minimum eccentricity: the middle of a longest path."""
+        far = self.breadth_first(component[0])[-1]
+        parents = dict(self.breadth_first_parents(far))
+        path = [self.breadth_first(far)[-1]]
+        while parents[path[-1]] is not None:
+            path.append(parents[path[-1]])
+        return path[len(path) // 2]
+
+    def centroid(self, component):
+        """Returns the node minimizing the table-size-weighted distance to all
+        other cliques of its component (a weighted centroid of the tree)."""
+        weights = {node: self.table_size(node) for node in component}
+        rooted = self.breadth_first_parents(component[0])
+        subtree = dict(weights)
+        for node, parent in rooted[::-1]:
+            if parent is not None:
+                subtree[parent] += subtree[node]
+        total = subtree[component[0]]
+        node = component[0]
+        parents = dict(rooted)
+        while True:
+            heavier = [child for child in self.graph.get_neighbors(node)
+                       if child != parents[node] and 2 * subtree[child] > total]
+            if len(heavier) == 0:
+                return node
+            node = heavier[0]
+
+    def table_size(self, node):
+        """Returns the number of entries in a full table over a cluster."""
+        size = 1
+        for name in self.clusters[node]:
+            size *= len(self.variables[name].get_domain())
+        return size
+
+    def cluster_variables(self, node):
+        """Returns the Variables of a cluster, sorted by name."""
+        return [self.variables[name] for name in sorted(self.clusters[node])]
+
+    def separator_variables(self, node1, node2):
+        """Returns the Variables shared by two clusters, sorted by name."""
+        return [self.variables[name] for name in sorted(self.clusters[node1] & self.clusters[node2])]
 
     def __str__(self):
         result = str(self.graph)
@@ -89,43 +396,591 @@ class BeliefPropagation:
         self.junction_tree = junction_tree
         self.messages = None
         self.factors = None
+        self.evidence = None
+        self.nodes_by_variable = defaultdict(set)
+        for node in self.junction_tree.factors:
+            for factor in self.junction_tree.factors[node]:
+                for var in factor.get_variables():
+                    self.nodes_by_variable[var.get_name()].add(node)
 
     def run(self, evidence):
-        self.factors = {node: [f.reduce(evidence) for f in self.junction_tree.factors[node]]
-                        for node in self.junction_tree.factors}
+        self.factors = {node: self.reduce_node(node, evidence) for node in self.junction_tree.factors}
         edges = self.junction_tree.init_message_queue()
-        messages = dict()
+        self.messages = dict()
         for (src, dest) in edges:
-            factors_to_multiply = [f for f in self.factors[src]]
-            for neighbor in self.junction_tree.graph.get_neighbors(src):
-                if neighbor != dest:
-                    factors_to_multiply.append(messages[(neighbor, src)])
-            message = multiply(factors_to_multiply)
-            for v in message.get_variables():
-                if v.get_name() not in self.junction_tree.clusters[dest]:
-                    message = message.sum_out(v)
-            messages[(src, dest)] = message
-        self.messages = messages
-
-    def get_marginals(self):
-        marginals = defaultdict(list)
-        for edge in self.messages:
-            marginals[edge[1]].append(self.messages[edge])
-        for node in marginals:
-            marginals[node] += self.factors[node]
-            marginals[node] = multiply(marginals[node])
-            for variable in marginals[node].get_variables():
-                if variable.get_name() not in self.junction_tree.clusters[node]:
-                    marginals[node] = marginals[node].sum_out(variable)
-        single_var_marginals = dict()
-        for node in marginals:
-            for variable in marginals[node].get_variables():
-                if variable.get_name() not in single_var_marginals:
-                    single_var_marginals[variable.get_name()] = marginals[node]
-        for var in single_var_marginals:
-            for other in single_var_marginals[var].get_variables():
-                if other.get_name() != var:
-                    single_var_marginals[var] = single_var_marginals[var].sum_out(other)
-        return {var: single_var_marginals[var].normalize() for var in single_var_marginals}
+            self.messages[(src, dest)] = self.compute_message(src, dest)
+        self.evidence = dict(evidence)
+
+    def update(self, evidence):
+        """Moves the calibrated tree to new evidence, recomputing as little as possible.
+
+        Only the cliques whose factors mention a variable whose evidence was
+        added, retracted or changed are re-reduced. A message is recomputed
+        only if it leaves one of those cliques or if one of the messages it
+        depends on actually changed; a recomputed message that comes out
+        proportional to the old one stops the change from spreading further.
+
+        Returns
+        -------
+        int
+            The number of messages that were recomputed.
+        """
+
+        if self.messages is None:
+            self.run(evidence)
+            return len(self.messages)
+        changed_vars = {var for var in set(evidence) | set(self.evidence)
+                        if evidence.get(var) != self.evidence.get(var)}
+        changed_nodes = set()
+        for var in changed_vars:
+            changed_nodes |= self.nodes_by_variable.get(var, set())
+        for node in changed_nodes:
+            self.factors[node] = self.reduce_node(node, evidence)
+        changed_messages = set()
+        recomputed = 0
+        for (src, dest) in self.junction_tree.init_message_queue():
+            if src in changed_nodes or any((neighbor, src) in changed_messages
+                                           for neighbor in self.junction_tree.graph.get_neighbors(src)
+                                           if neighbor != dest):
+                message = self.compute_message(src, dest)
+                recomputed += 1
+                if not proportional(message, self.messages[(src, dest)]):
+                    self.messages[(src, dest)] = message
+                    changed_messages.add((src, dest))
+        self.evidence = dict(evidence)
+        return recomputed
+
+    def reduce_node(self, node, evidence):
+        """Returns the clique's potential, reduced by the evidence, as a list
+        of factors (empty if the clique has no factors)."""
+        potential = self.junction_tree.get_potential(node)
+        return [] if potential is None else [potential.reduce(evidence)]
+
+    def compute_message(self, src, dest):
+        factors_to_multiply = [f for f in self.factors[src]]
+        for neighbor in self.junction_tree.graph.get_neighbors(src):
+            if neighbor != dest:
+                factors_to_multiply.append(self.messages[(neighbor, src)])
+        return self.marginalize(factors_to_multiply, self.junction_tree.clusters[dest])
+
+    def marginalize(self, factors, keep):
+        """Multiplies factors and sums out every variable not in `keep`."""
+        return multiply_marginalize(factors, keep)
+
+    def get_marginals(self, variables=None):
+        """Computes the posterior marginal of each variable.
+
+        Each marginal is read off the smallest calibrated table that contains
+        the variable: either a clique (its factors times all its incoming
+        messages) or a separator (the product of the two messages crossing
+        the edge), and is obtained with a single contraction.
+
+        Parameters
+        ----------
+        variables : iterable[str], optional
+            The names of the variables to compute. By default every variable
+            in the junction tree; names not in the tree are skipped.
+
+        Returns
+        -------
+        dict[str, Factor | DenseFactor]
+            The normalized marginal of each requested variable.
+        """
+
+        if variables is None:
+            variables = self.junction_tree.variables
+        separators = defaultdict(list)
+        for (src, dest) in self.messages:
+            if src < dest:
+                for name in self.junction_tree.clusters[src] & self.junction_tree.clusters[dest]:
+                    separators[name].append((src, dest))
+        marginals = dict()
+        for name in variables:
+            if name not in self.junction_tree.variables:
+                continue
+            candidates = [(self.junction_tree.table_size(node), self.clique_belief, node)
+                          for node in self.junction_tree.node_map[name]]
+            candidates += [(self.separator_size(edge), self.separator_belief, edge)
+                           for edge in separators[name]]
+            _, belief, location = min(candidates, key=lambda candidate: candidate[0])
+            marginals[name] = self.marginalize(belief(location), [name]).normalize()
+        return marginals
+
+    def clique_belief(self, node):
+        """Returns the factors whose product is the belief at a clique."""
+        return self.factors[node] + [self.messages[(neighbor, node)]
+                                     for neighbor in self.junction_tree.graph.get_neighbors(node)]
+
+    def separator_belief(self, edge):
+        """Returns the two messages whose product is the belief at a separator."""
+        src, dest = edge
+        return [self.messages[(src, dest)], self.messages[(dest, src)]]
+
+    def separator_size(self, edge):
+        """Returns the number of entries in a full table over a separator."""
+        size = 1
+        for name in self.junction_tree.clusters[edge[0]] & self.junction_tree.clusters[edge[1]]:
+            size *= len(self.junction_tree.variables[name].get_domain())
+        return size
+
+
+class MaxProductPropagation(BeliefPropagation):
+    """Max-product propagation, for the most probable explanation (MPE).
+
+    Messages maximize out variables instead of summing them out, using the
+    same compiled potentials and schedule as BeliefPropagation. After a run,
+    get_marginals returns normalized max-marginals: for each value of a
+    variable, the probability of the best full assignment that gives it that
+    value, relative to the other values. get_mpe recovers the best full
+    assignment itself.
+    """
+
+    def marginalize(self, factors, keep):
+        return multiply_maximize(factors, keep)
+
+    def get_mpe(self):
+        """Returns the most probable assignment of every variable given the
+        evidence, as a dict from variable names to values.
+
+        Each connected component is traced back from an arbitrary clique in
+        breadth-first order: a clique's belief is reduced by the values
+        already chosen for its separator with its parent, and the rest of its
+        variables are set to the argmax. Calibration guarantees that the
+        choices agree with each other.
+        """
+
+        assignment = dict()
+        visited = set()
+        for root in self.junction_tree.graph.nodes:
+            if root in visited:
+                continue
+            for node, _ in self.junction_tree.breadth_first_parents(root):
+                visited.add(node)
+                belief = multiply_dense(self.clique_belief(node)).reduce(assignment)
+                table = belief.get_table()
+                codes = np.unravel_index(np.argmax(table), table.shape)
+                for var, code in zip(belief.get_variables(), codes):
+                    assignment.setdefault(var.get_name(), var.get_domain()[code])
+        return assignment
+
+
+class ParallelBeliefPropagation(BeliefPropagation):
+    """Shafer-Shenoy propagation split by subtree across worker processes.
+
+    The rooted tree of the message schedule is cut into connected parts of
+    about equal size (parts_per_worker per worker). Each part is one task
+    per pass. On the collect pass a worker computes all of the part's
+    messages towards the root, and on the distribute pass all of those away
+    from it. Only the evidence and the messages entering the part travel
+    with a task, and a task is submitted as soon as the parts it depends on
+    are done. Each worker receives its copy of the tree once, when the pool
+    starts.
+
+    Messages between the small cliques of pedigree networks are mostly
+    Python work, so parts are run in processes rather than threads. With a
+    single worker, the run is serial.
+    """
+
+    def __init__(self, junction_tree, max_workers=None, parts_per_worker=4):
+        super().__init__(junction_tree)
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.parts_per_worker = parts_per_worker
+
+    def split(self, num_parts):
+        """Cuts the rooted trees of the message schedule into parts of about
+        len(nodes) / num_parts cliques: subtrees are cut off bottom-up once
+        they reach that size, and the small pieces left at the roots (whole
+        components, for a forest) are grouped together.
+
+        Returns
+        -------
+        (dict, dict)
+            The part of every clique (named by one of its cliques), and the
+            parent of every clique that is not a root.
+        """
+        schedule = self.junction_tree.init_message_queue()
+        distribute = schedule[len(schedule) // 2:]
+        parent = {child: node for node, child in distribute}
+        target = max(1, len(self.junction_tree.graph.nodes) // num_parts)
+        size = {node: 1 for node in self.junction_tree.graph.nodes}
+        part = dict()
+        for node, child in distribute[::-1]:
+            if size[child] >= target:
+                part[child] = child
+            else:
+                size[node] += size[child]
+        group, group_size = None, 0
+        for node in self.junction_tree.graph.nodes:
+            if node in parent:
+                continue
+            if group is None or group_size >= target:
+                group, group_size = node, 0
+            part[node] = group
+            group_size += size[node]
+        for node, child in distribute:
+            if child not in part:
+                part[child] = part[node]
+        return part, parent
+
+    def run(self, evidence):
+        if self.max_workers <= 1:
+            super().run(evidence)
+            return
+        self.factors = {node: self.reduce_node(node, evidence) for node in self.junction_tree.factors}
+        part, parent = self.split(self.max_workers * self.parts_per_worker)
+        schedule = self.junction_tree.init_message_queue()
+        distribute = schedule[len(schedule) // 2:]
+        edges = defaultdict(list)
+        nodes = defaultdict(list)
+        for node in self.junction_tree.graph.nodes:
+            nodes[part[node]].append(node)
+        for node, child in distribute[::-1]:
+            edges[('collect', part[child])].append((child, node))
+        for node, child in distribute:
+            edges[('distribute', part[node])].append((node, child))
+        depends = defaultdict(set)
+        for top in nodes:
+            depends[('distribute', top)].add(('collect', top))
+        for node, child in distribute:
+            if part[node] != part[child]:
+                depends[('collect', part[node])].add(('collect', part[child]))
+                depends[('distribute', part[child])].add(('distribute', part[node]))
+        dependents = defaultdict(list)
+        for task, requirements in depends.items():
+            for requirement in requirements:
+                dependents[requirement].append(task)
+        waiting = {(kind, top): len(depends[(kind, top)])
+                   for top in nodes for kind in ['collect', 'distribute']}
+        # The distribute pass of a part also needs the upward messages of the
+        # parts below it. Results are forwarded to workers still packed.
+        inputs = {task: depends[task] | (depends[('collect', task[1])] if task[0] == 'distribute' else set())
+                  for task in waiting}
+        results = dict()
+
+        def submit(task):
+            return pool.submit(compute_part_messages, evidence, nodes[task[1]], edges[task],
+                               [results[requirement] for requirement in inputs[task]])
+
+        # Forked workers inherit the tree instead of unpickling a copy each.
+        context = (multiprocessing.get_context('fork')
+                   if 'fork' in multiprocessing.get_all_start_methods() else None)
+        with ProcessPoolExecutor(self.max_workers, mp_context=context, initializer=start_part_worker,
+                                 initargs=(self.junction_tree,)) as pool:
+            pending = {submit(task): task for task, count in waiting.items() if count == 0}
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = pending.pop(future)
+                    results[task] = future.result()
+                    for dependent in dependents[task]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            pending[submit(dependent)] = dependent
+        self.messages = dict()
+        for packed in results.values():
+            self.messages.update(unpack_messages(self.junction_tree, packed))
+        self.evidence = dict(evidence)
+
+
+_part_worker = None
+
+
+def start_part_worker(junction_tree):
+    """Initializes a ParallelBeliefPropagation worker process."""
+    global _part_worker
+    _part_worker = BeliefPropagation(junction_tree)
+
+
+def compute_part_messages(evidence, nodes, edges, incoming):
+    """Computes, in a worker process, the messages along `edges` (in order)
+    from the cliques `nodes`, given packed messages that include all of
+    those entering them. Returns the new messages, packed."""
+    _part_worker.factors = {node: _part_worker.reduce_node(node, evidence) for node in nodes}
+    _part_worker.messages = dict()
+    wanted = set(nodes)
+    for packed in incoming:
+        _part_worker.messages.update(unpack_messages(_part_worker.junction_tree, packed, wanted))
+    for (src, dest) in edges:
+        _part_worker.messages[(src, dest)] = _part_worker.compute_message(src, dest)
+    return pack_messages(_part_worker.junction_tree,
+                         {edge: _part_worker.messages[edge] for edge in edges})
+
+
+def pack_messages(junction_tree, messages):
+    """Flattens messages into a single array, each aligned to the variables
+    of its separator (sorted by name), so that they pickle cheaply.
+
+    Returns
+    -------
+    (list[(int, int)], np.ndarray, np.ndarray, np.ndarray)
+        The edges, the concatenated tables, the offset of each table and
+        whether each message is in log domain.
+    """
+    edges = list(messages)
+    tables, log_domain = [], []
+    for (src, dest) in edges:
+        message = messages[(src, dest)]
+        if not isinstance(message, DenseFactor):
+            message = message.to_dense()
+        variables = junction_tree.separator_variables(src, dest)
+        table = align_table(message, variables)
+        if len(message.get_variables()) < len(variables):
+            table = np.broadcast_to(table, [len(var.get_domain()) for var in variables])
+        tables.append(table.ravel())
+        log_domain.append(message.is_log_domain())
+    offsets = np.cumsum([0] + [len(table) for table in tables])
+    values = np.concatenate(tables) if len(tables) > 0 else np.zeros(0)
+    return edges, values, offsets, np.array(log_domain, dtype=bool)
+
+
+def unpack_messages(junction_tree, packed, dests=None):
+    """Rebuilds the messages packed by pack_messages (only those sent to the
+    cliques `dests`, if given), as DenseFactors."""
+    edges, values, offsets, log_domain = packed
+    messages = dict()
+    for k, (src, dest) in enumerate(edges):
+        if dests is not None and dest not in dests:
+            continue
+        variables = junction_tree.separator_variables(src, dest)
+        table = values[offsets[k]:offsets[k + 1]].reshape([len(var.get_domain()) for var in variables])
+        messages[(src, dest)] = DenseFactor(variables, table, bool(log_domain[k]))
+    return messages
+
+
+BATCH = 'batch'
+
+
+class BatchBeliefPropagation:
+    """Shafer-Shenoy propagation of many evidence sets at once.
+
+    Every message carries a leading batch axis with one row per evidence set,
+    so the whole batch is propagated with one contraction per edge instead of
+    one run per case. Clique potentials are shared by all cases; evidence
+    enters as a 0/1 indicator array over (case, value) for each observed
+    variable, attached to the smallest clique containing it. Messages are
+    normalized row by row, which keeps long chains from underflowing.
+
+    Cases may also differ in their parameters. Each slot names variables
+    whose prior factors (the factors over that variable alone) are left out
+    of the compiled clique tables; run() then takes one prior table per case
+    for every slot, e.g. a grid of allele frequencies shared by all founders.
+    """
+
+    def __init__(self, junction_tree, slots=None):
+        self.junction_tree = junction_tree
+        self.slots = defaultdict(list)
+        left_out = defaultdict(list)
+        for slot, names in (slots or dict()).items():
+            for name in names:
+                node, factor = self.prior_factor(name)
+                self.slots[node].append((slot, junction_tree.variables[name]))
+                left_out[node].append(factor)
+        self.slots = dict(self.slots)
+        self.tables = dict()
+        for node in junction_tree.factors:
+            variables = junction_tree.cluster_variables(node)
+            if node in left_out:
+                factors = [factor for factor in junction_tree.factors[node]
+                           if not any(factor is other for other in left_out[node])]
+                potential = (multiply_marginalize(factors, junction_tree.clusters[node])
+                             if len(factors) > 0 else None)
+            else:
+                potential = junction_tree.get_potential(node)
+            table = np.ones([len(var.get_domain()) for var in variables])
+            if potential is not None:
+                table = table * align_table(potential.to_dense(), variables)
+            self.tables[node] = table
+        self.batch_size = None
+        self.indicators = None
+        self.parameters = None
+        self.messages = None
+        self.marginals = None
+
+    def prior_factor(self, name):
+        """Returns the clique holding the factor over variable `name` alone,
+        and that factor."""
+        for node in self.junction_tree.node_map.get(name, []):
+            for factor in self.junction_tree.factors[node]:
+                variables = factor.get_variables()
+                if len(variables) == 1 and variables[0].get_name() == name:
+                    return node, factor
+        raise ValueError('No prior factor over variable {}'.format(name))
+
+    def run(self, evidence_list, parameters=None):
+        """Propagates a list of evidence dicts (one per case).
+
+        Parameters
+        ----------
+        evidence_list : list[dict[str, str]]
+            The evidence of each case.
+        parameters : dict[str, numpy.ndarray], optional
+            For each slot, an array of shape (cases, domain size) holding
+            the prior of the slot's variables in each case.
+        """
+        self.batch_size = len(evidence_list)
+        self.indicators = self.evidence_indicators(evidence_list)
+        self.parameters = dict()
+        for node, slots in self.slots.items():
+            for slot, var in slots:
+                if parameters is None or slot not in parameters:
+                    raise ValueError('No prior tables given for slot {!r}'.format(slot))
+                table = np.asarray(parameters[slot], dtype=float)
+                if table.shape != (self.batch_size, len(var.get_domain())):
+                    raise ValueError('Prior tables for slot {!r} have shape {}, expected {}'.format(
+                        slot, table.shape, (self.batch_size, len(var.get_domain()))))
+                self.parameters[slot] = table
+        self.messages = dict()
+        self.marginals = dict()
+        for (src, dest) in self.junction_tree.init_message_queue():
+            self.messages[(src, dest)] = self.compute_message(src, dest)
+
+    def evidence_indicators(self, evidence_list):
+        """Returns, for each clique, a list of (Variable, indicator) pairs where
+        the indicator has shape (cases, domain size)."""
+        observed = dict()
+        for case, evidence in enumerate(evidence_list):
+            for name, value in evidence.items():
+                if name not in self.junction_tree.variables:
+                    continue
+                var = self.junction_tree.variables[name]
+                if name not in observed:
+                    observed[name] = np.ones((len(evidence_list), len(var.get_domain())))
+                observed[name][case] = 0.0
+                code = var._codes.get(value, -1)
+                if code >= 0:
+                    observed[name][case, code] = 1.0
+        indicators = defaultdict(list)
+        for name, indicator in observed.items():
+            node = min(self.junction_tree.node_map[name], key=self.junction_tree.table_size)
+            indicators[node].append((self.junction_tree.variables[name], indicator))
+        return indicators
+
+    def clique_operands(self, node, exclude=None):
+        """Returns the tables and labels whose product is the belief at a
+        clique, leaving out the message from `exclude`."""
+        tables = [self.tables[node], np.ones(self.batch_size)]
+        labels = [self.junction_tree.cluster_variables(node), [BATCH]]
+        for var, indicator in self.indicators.get(node, []):
+            tables.append(indicator)
+            labels.append([BATCH, var])
+        for slot, var in self.slots.get(node, []):
+            tables.append(self.parameters[slot])
+            labels.append([BATCH, var])
+        for neighbor in self.junction_tree.graph.get_neighbors(node):
+            if neighbor != exclude:
+                message_vars, message = self.messages[(neighbor, node)]
+                tables.append(message)
+                labels.append([BATCH] + message_vars)
+        return tables, labels
+
+    def compute_message(self, src, dest):
+        separator = self.junction_tree.clusters[src] & self.junction_tree.clusters[dest]
+        separator_vars = [self.junction_tree.variables[name] for name in sorted(separator)]
+        tables, labels = self.clique_operands(src, exclude=dest)
+        return separator_vars, normalize_rows(contract(tables, labels, [BATCH] + separator_vars))
+
+    def get_marginals(self, variables=None):
+        """Returns a dict mapping each variable name (or those given) to an
+        array of shape (cases, domain size) whose rows are the per-case
+        posteriors. Marginals are computed once per run and then reused."""
+        marginals = dict()
+        for name, var in self.junction_tree.variables.items():
+            if variables is not None and name not in variables:
+                continue
+            if name not in self.marginals:
+                node = min(self.junction_tree.node_map[name], key=self.junction_tree.table_size)
+                tables, labels = self.clique_operands(node)
+                self.marginals[name] = normalize_rows(contract(tables, labels, [BATCH, var]))
+            marginals[name] = self.marginals[name]
+        return marginals
+
+    def get_case_marginals(self, case, variables=None):
+        """Returns the marginals of a single case (for all variables or those
+        given), as DenseFactors in the format of
+        BeliefPropagation.get_marginals."""
+        return {name: DenseFactor([self.junction_tree.variables[name]], table[case])
+                for name, table in self.get_marginals(variables).items()}
+
+
+def normalize_rows(table):
+    """Scales each row (the slice along the first axis) of an array to sum to
+    one, leaving rows that sum to zero untouched."""
+    totals = table.reshape(table.shape[0], -1).sum(axis=1)
+    totals = np.where(totals > 0, totals, 1.0)
+    return table / totals.reshape((-1,) + (1,) * (table.ndim - 1))
+
+
+class HuginPropagation:
+    """Hugin-style propagation on a junction tree.
+
+    Each clique keeps a single potential table over all of its variables,
+    initialized once per run to the product of its factors, and each edge
+    keeps a separator table. Passing a message sums the source potential onto
+    the separator and multiplies the destination potential by the ratio of
+    the new separator table to the old one. Unlike the Shafer-Shenoy scheme
+    of BeliefPropagation, a clique's product is never recomputed once per
+    neighbor, and after a run every potential is the clique's joint belief.
+    """
+
+    def __init__(self, junction_tree):
+        self.junction_tree = junction_tree
+        self.potentials = None
+        self.separators = None
+
+    def run(self, evidence):
+        self.potentials = {node: self.initial_potential(node).reduce(evidence)
+                           for node in self.junction_tree.factors}
+        self.separators = dict()
+        for (src, dest) in self.junction_tree.init_message_queue():
+            self.pass_message(src, dest)
+
+    def initial_potential(self, node):
+        variables = self.junction_tree.cluster_variables(node)
+        ones = DenseFactor(variables, np.ones([len(var.get_domain()) for var in variables]))
+        potential = self.junction_tree.get_potential(node)
+        return multiply_marginalize([ones] + ([] if potential is None else [potential]),
+                                    self.junction_tree.clusters[node])
+
+    def pass_message(self, src, dest):
+        edge = frozenset((src, dest))
+        separator = self.junction_tree.clusters[src] & self.junction_tree.clusters[dest]
+        new_separator = multiply_marginalize([self.potentials[src]], separator)
+        if edge in self.separators:
+            update = divide(new_separator, self.separators[edge])
+        else:
+            update = new_separator
+        self.potentials[dest] = multiply_marginalize([self.potentials[dest], update],
+                                                     self.junction_tree.clusters[dest])
+        self.separators[edge] = new_separator
+
+    def get_marginals(self, variables=None):
+        wanted = None if variables is None else set(variables)
+        best = dict()
+        for node, potential in self.potentials.items():
+            for var in potential.get_variables():
+                name = var.get_name()
+                if wanted is not None and name not in wanted:
+                    continue
+                if name not in best or potential.get_table().size < best[name].get_table().size:
+                    best[name] = potential
+        return {name: multiply_marginalize([potential], [name]).normalize()
+                for name, potential in best.items()}
+
+
+ARCHITECTURES = {'shafer-shenoy': BeliefPropagation, 'hugin': HuginPropagation}
+
+
+def make_propagation(junction_tree, architecture='shafer-shenoy'):
+    """Creates a propagation engine ('shafer-shenoy' or 'hugin') for a junction tree."""
+    return ARCHITECTURES[architecture](junction_tree)
 
 
+def proportional(factor1, factor2):
+    """Checks whether two factors over the same variables differ only by a
+    constant factor (so that either gives the same normalized beliefs)."""
+    factor1, factor2 = factor1.to_dense(), factor2.to_dense()
+    if factor1.get_variables() != factor2.get_variables():
+        return False
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table1, table2 = factor1.normalize().get_table(), factor2.normalize().get_table()
+    return bool(np.allclose(table1, table2, rtol=1e-12, atol=0.0))
@@ -0,0 +1,582 @@
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import time
+import warnings
+import numpy as np
+from factor import DenseFactor, align_table, contract
+from bayes import UndirectedGraph
+from elimination import min_degree_elim_order, elim_order_stats
+from junction import BATCH
+
+
+class CompiledNetwork:
+    """The factors of a Bayesian network as dense tables over integer codes,
+    with the variables in topological order.
+
+    The last variable of each factor is taken to be its child. A variable
+    with several factors (e.g. a repeated CPT) is sampled from their
+    normalized product, and the normalizer is charged to the sample weight.
+    """
+
+    def __init__(self, bnet):
+        factors = [factor.to_dense() for factor in bnet.get_factors()]
+        children = defaultdict(list)
+        for factor in factors:
+            children[factor.get_variables()[-1]].append(factor)
+        missing = [var.get_name() for var in bnet.get_variables() if var not in children]
+        if len(missing) > 0:
+            raise ValueError('No conditional table for: {}'.format(', '.join(missing)))
+        parents = {var: list(dict.fromkeys(v for factor in children[var]
+                                           for v in factor.get_variables() if v != var))
+                   for var in children}
+        self.variables = topological_order(parents)
+        self.index = {var.get_name(): i for i, var in enumerate(self.variables)}
+        self.domain_sizes = np.array([len(var.get_domain()) for var in self.variables])
+        self.offsets = np.concatenate([[0], np.cumsum(self.domain_sizes)])
+        self.parents = []
+        self.conditionals = []
+        for var in self.variables:
+            scope = parents[var] + [var]
+            table = np.ones([len(v.get_domain()) for v in scope])
+            for factor in children[var]:
+                table = table * align_table(factor, scope)
+            self.parents.append([self.index[v.get_name()] for v in parents[var]])
+            self.conditionals.append(table)
+        self.factors = [([self.index[v.get_name()] for v in factor.get_variables()],
+                         factor.get_table()) for factor in factors]
+
+    def encode_evidence(self, evidence):
+        """Maps the position of each observed variable to the code of its
+        value (-1 for a value outside its domain). Unknown names are skipped."""
+        return {self.index[name]: self.variables[self.index[name]]._codes.get(value, -1)
+                for name, value in evidence.items() if name in self.index}
+
+    def tally(self, codes, weights):
+        """Returns the total weight of each value of each variable, laid out
+        flat (variable i occupies offsets[i]:offsets[i + 1])."""
+        return np.concatenate([np.bincount(codes[:, i], weights=weights, minlength=size)
+                               for i, size in enumerate(self.domain_sizes)])
+
+
+def topological_order(parents):
+    """Orders the keys of a dict from nodes to their parents so that parents
+    come first. Raises ValueError if the graph has a cycle."""
+    remaining = {node: len(node_parents) for node, node_parents in parents.items()}
+    children = defaultdict(list)
+    for node, node_parents in parents.items():
+        for parent in node_parents:
+            children[parent].append(node)
+    order = [node for node in parents if remaining[node] == 0]
+    for node in order:
+        for child in children[node]:
+            remaining[child] -= 1
+            if remaining[child] == 0:
+                order.append(child)
+    if len(order) < len(parents):
+        raise ValueError('The network has a directed cycle')
+    return order
+
+
+class SamplingResult:
+    """A running estimate of the marginals of a network from weighted samples.
+
+    Weighted value counts are kept per chain (an independent stream of
+    samples), relative to a common log scale so that weights of very
+    different magnitudes can be accumulated without underflow.
+    """
+
+    def __init__(self, network, num_chains=1):
+        self.network = network
+        self.totals = np.zeros((num_chains, network.offsets[-1]))
+        self.weight_sums = np.zeros(num_chains)
+        self.weight_square_sums = np.zeros(num_chains)
+        self.num_samples = np.zeros(num_chains, dtype=int)
+        self.log_scale = -np.inf
+        self.elapsed = 0.0
+
+    def add(self, chain, totals, log_scale, weight_sum, weight_square_sum, num_samples):
+        """Adds a batch of samples, given as its tally (see CompiledNetwork.tally)
+        and weight sums, all relative to exp(log_scale)."""
+        self.num_samples[chain] += num_samples
+        if weight_sum == 0:
+            return
+        if log_scale > self.log_scale:
+            rescale = np.exp(self.log_scale - log_scale)
+            self.totals *= rescale
+            self.weight_sums *= rescale
+            self.weight_square_sums *= rescale ** 2
+            self.log_scale = log_scale
+        rescale = np.exp(log_scale - self.log_scale)
+        self.totals[chain] += rescale * totals
+        self.weight_sums[chain] += rescale * weight_sum
+        self.weight_square_sums[chain] += rescale ** 2 * weight_square_sum
+
+    def get_marginals(self, variables=None):
+        """Returns the estimated marginals, in the format of
+        BeliefPropagation.get_marginals (all zeros if no sample had weight)."""
+        if variables is None:
+            variables = self.network.index
+        totals = self.totals.sum(axis=0)
+        marginals = dict()
+        for name in variables:
+            i = self.network.index[name]
+            table = totals[self.network.offsets[i]:self.network.offsets[i + 1]]
+            total = table.sum()
+            marginals[name] = DenseFactor([self.network.variables[i]],
+                                          table / total if total > 0 else table)
+        return marginals
+
+    def effective_sample_size(self):
+        """Returns Kish's effective sample size, (sum of weights)^2 / (sum of
+        squared weights). This accounts for uneven weights only, not for the
+        autocorrelation of Markov chain samples."""
+        square_sum = self.weight_square_sums.sum()
+        return self.weight_sums.sum() ** 2 / square_sum if square_sum > 0 else 0.0
+
+    def rhat(self):
+        """Returns the Gelman-Rubin potential scale reduction of each variable
+        (the largest over the indicators of its values), comparing the chains.
+        Values near 1 suggest convergence; nan if there are fewer than two
+        chains or samples per chain."""
+        n = self.num_samples.min()
+        if len(self.num_samples) < 2 or n < 2:
+            return {name: np.nan for name in self.network.index}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.totals / self.weight_sums[:, None]
+            within = (n / (n - 1) * means * (1 - means)).mean(axis=0)
+            between = means.var(axis=0, ddof=1)
+            pooled = (n - 1) / n * within + between
+            ratios = np.where(pooled == 0, 1.0, np.sqrt(pooled / within))
+        return {name: float(ratios[self.network.offsets[i]:self.network.offsets[i + 1]].max())
+                for name, i in self.network.index.items()}
+
+
+def draw(probs, rng):
+    """Draws one category per row of a (rows, categories) array of
+    unnormalized probabilities."""
+    cumulative = np.cumsum(probs, axis=1)
+    thresholds = rng.random(len(probs)) * cumulative[:, -1]
+    return np.minimum((cumulative <= thresholds[:, None]).sum(axis=1), probs.shape[1] - 1)
+
+
+def weighted_samples(network, evidence, size, rng):
+    """Draws samples by likelihood weighting: variables are sampled in
+    topological order and observed ones are clamped, multiplying the sample
+    weight by their probability. Returns (codes, log weights)."""
+    codes = np.zeros((size, len(network.variables)), dtype=np.intp)
+    log_weights = np.zeros(size)
+    with np.errstate(divide='ignore'):
+        for i, (parents, table) in enumerate(zip(network.parents, network.conditionals)):
+            probs = np.broadcast_to(table[tuple(codes[:, p] for p in parents)],
+                                    (size, network.domain_sizes[i]))
+            if i in evidence:
+                if evidence[i] < 0:
+                    log_weights[:] = -np.inf
+                else:
+                    codes[:, i] = evidence[i]
+                    log_weights += np.log(probs[:, evidence[i]])
+            else:
+                log_weights += np.log(probs.sum(axis=1))
+                codes[:, i] = draw(probs, rng)
+    return codes, log_weights
+
+
+def likelihood_weighting_batch(network, evidence, size, seed):
+    """Draws a batch of weighted samples and returns its tally, in the form
+    expected by SamplingResult.add."""
+    codes, log_weights = weighted_samples(network, evidence, size, np.random.default_rng(seed))
+    log_scale = np.max(log_weights)
+    if not np.isfinite(log_scale):
+        return np.zeros(network.offsets[-1]), 0.0, 0.0, 0.0, size
+    weights = np.exp(log_weights - log_scale)
+    return network.tally(codes, weights), log_scale, weights.sum(), (weights ** 2).sum(), size
+
+
+def gibbs_blocks(network, evidence, max_table_size):
+    """Groups the unobserved variables into blocks to be resampled jointly.
+
+    As in blocking Gibbs sampling, each block is as large as possible: it is
+    grown breadth-first over the moral graph from a variable not yet in any
+    block, adding each neighbor as long as eliminating the block (with every
+    other variable fixed) needs no table larger than max_table_size. Blocks
+    may overlap. Large blocks matter because deterministic relations, as in
+    pedigrees, leave small blocks unable to move.
+
+    Each block is returned as (terms, steps). Each term is (table, index,
+    labels): indexing a factor table with `index` (an index of None stands
+    for each chain's current value of that variable) gives, for each chain,
+    a table over the block variables in `labels`. The steps are the buckets
+    of the elimination order, as (variable, inputs, labels): the bucket
+    multiplies the tables numbered `inputs` (terms first, then the result
+    of each step in turn) into a table over `labels`.
+    """
+
+    neighbors = defaultdict(set)
+    for scope, _ in network.factors:
+        free = [p for p in scope if p not in evidence]
+        for position in free:
+            neighbors[position].update(free)
+    sizes = dict(enumerate(int(size) for size in network.domain_sizes))
+    covered = set()
+    blocks = []
+    for seed in range(len(network.variables)):
+        if seed in evidence or seed in covered:
+            continue
+        block = {seed}
+        frontier = deque(sorted(neighbors[seed] - {seed}))
+        queued = set(frontier) | {seed}
+        while len(frontier) > 0:
+            candidate = frontier.popleft()
+            _, largest_table = block_elimination(neighbors, block | {candidate}, sizes)
+            if largest_table <= max_table_size:
+                block.add(candidate)
+                for neighbor in sorted(neighbors[candidate] - queued):
+                    frontier.append(neighbor)
+                    queued.add(neighbor)
+        covered |= block
+        order, _ = block_elimination(neighbors, block, sizes)
+        terms = []
+        index_by_label = defaultdict(set)
+        for scope, table in network.factors:
+            labels = [p for p in scope if p in block]
+            if len(labels) > 0:
+                index = []
+                for p in scope:
+                    if p in block:
+                        axis_shape = [1] * (len(labels) + 1)
+                        axis_shape[1 + labels.index(p)] = sizes[p]
+                        index.append((p, np.arange(sizes[p]).reshape(axis_shape)))
+                    else:
+                        index.append((p, None))
+                for label in labels:
+                    index_by_label[label].add(len(terms))
+                terms.append((table, index, labels))
+        steps = []
+        table_labels = [[BATCH] + labels for _, _, labels in terms]
+        for position in order:
+            inputs = sorted(index_by_label.pop(position))
+            labels = [BATCH] + list(dict.fromkeys(label for k in inputs for label in table_labels[k]
+                                                  if label != BATCH))
+            steps.append((position, inputs, labels))
+            for label in labels[1:]:
+                if label != position:
+                    index_by_label[label] -= set(inputs)
+                    index_by_label[label].add(len(table_labels))
+            table_labels.append([label for label in labels if label != position])
+        blocks.append((terms, steps))
+    return blocks
+
+
+def block_elimination(neighbors, block, sizes):
+    """Returns a min-degree elimination order for a block of variables (with
+    all others fixed) and the size of its largest table."""
+    graph = UndirectedGraph(sorted(block), [(p, q) for p in block for q in neighbors[p]
+                                            if q in block and p < q])
+    order = min_degree_elim_order(graph, sizes)
+    return order, elim_order_stats(graph, order, sizes)[1]
+
+
+def initial_states(network, evidence, num_chains, rng, batch_size=1000, max_batches=100,
+                   patience=5):
+    """Picks starting states for Gibbs chains that are consistent with the
+    evidence and as spread out as possible.
+
+    Distinct states of positive weight are collected from likelihood
+    weighting samples (until there are enough, or `patience` batches in a
+    row find no new one), and num_chains of them are drawn without
+    replacement, in proportion to their weights. If there are fewer distinct
+    states than chains, every one is used, some chains share a start and a
+    warning is issued, since rhat is then less reliable. Raises ValueError
+    if no sample has positive weight.
+    """
+    codes = np.zeros((0, len(network.variables)), dtype=np.intp)
+    log_weights = np.zeros(0)
+    stale = 0
+    for _ in range(max_batches):
+        batch_codes, batch_log_weights = weighted_samples(network, evidence, batch_size, rng)
+        possible = np.isfinite(batch_log_weights)
+        found = len(codes)
+        codes = np.concatenate([codes, batch_codes[possible]])
+        log_weights = np.concatenate([log_weights, batch_log_weights[possible]])
+        codes, first = np.unique(codes, axis=0, return_index=True)
+        log_weights = log_weights[first]
+        stale = stale + 1 if 0 < len(codes) == found else 0
+        if len(codes) >= num_chains or stale == patience:
+            break
+    if len(codes) == 0:
+        raise ValueError('Could not find a state consistent with the evidence')
+    weights = np.maximum(np.exp(log_weights - np.max(log_weights)), 1e-300)
+    if len(codes) >= num_chains:
+        return codes[rng.choice(len(codes), size=num_chains, replace=False, p=weights / weights.sum())]
+    warnings.warn(f'Only {len(codes)} distinct starting states for {num_chains} Gibbs chains; '
+                  f'rhat may overstate convergence')
+    extra = rng.choice(len(codes), size=num_chains - len(codes), p=weights / weights.sum())
+    return codes[np.concatenate([np.arange(len(codes)), extra])]
+
+
+def sample_block(block, state, rng):
+    """Resamples the variables of a block jointly, given every other variable,
+    for each chain (row of `state`), in place.
+
+    The block is summed out by bucket elimination with a batch axis over the
+    chains, keeping each bucket's product; the variables are then drawn in
+    reverse elimination order, each from its bucket indexed by the values
+    already drawn.
+    """
+
+    terms, steps = block
+    chains = len(state)
+    tables, labels = [], []
+    for table, index, table_labels in terms:
+        chain_shape = (-1,) + (1,) * len(table_labels)
+        table = table[tuple(state[:, p].reshape(chain_shape) if values is None else values
+                            for p, values in index)]
+        tables.append(np.broadcast_to(table, (chains,) + table.shape[1:]))
+        labels.append([BATCH] + table_labels)
+    buckets = []
+    for position, inputs, bucket_labels in steps:
+        product = contract([tables[k] for k in inputs], [labels[k] for k in inputs], bucket_labels)
+        # Rescale each chain's bucket so that long blocks cannot underflow.
+        scale = product.reshape(chains, -1).max(axis=1)
+        product = product / np.where(scale > 0, scale, 1.0).reshape((-1,) + (1,) * (product.ndim - 1))
+        buckets.append((position, bucket_labels, product))
+        tables.append(product.sum(axis=bucket_labels.index(position)))
+        labels.append([label for label in bucket_labels if label != position])
+    rows = np.arange(chains)
+    drawn = dict()
+    for position, bucket_labels, product in reversed(buckets):
+        probs = product[tuple(rows if label == BATCH else slice(None) if label == position
+                              else drawn[label] for label in bucket_labels)]
+        drawn[position] = draw(probs, rng)
+    for position, codes in drawn.items():
+        state[:, position] = codes
+
+
+def gibbs_sweeps(network, blocks, state, num_sweeps, seed, record):
+    """Runs blocked Gibbs sweeps on a batch of chains (one row of `state`
+    each). Returns the final state and, if record is set, the number of
+    times each chain visited each value of each variable."""
+    rng = np.random.default_rng(seed)
+    state = state.copy()
+    counts = np.zeros((len(state), network.offsets[-1]))
+    rows = np.arange(len(state))[:, None]
+    for _ in range(num_sweeps):
+        for block in blocks:
+            sample_block(block, state, rng)
+        if record:
+            counts[rows, network.offsets[:-1] + state] += 1
+    return state, counts
+
+
+_worker_call = None
+
+
+def start_worker_pool(num_workers, function, *shared):
+    """Starts a process pool for worker_map, or returns None if num_workers
+    is 1. The arguments that stay the same on every call (such as the
+    compiled network) are sent to each worker once, when it starts."""
+    if num_workers <= 1:
+        return None
+    return ProcessPoolExecutor(num_workers, initializer=start_worker,
+                               initargs=(function,) + shared)
+
+
+def start_worker(function, *shared):
+    """Initializes a worker process of start_worker_pool."""
+    global _worker_call
+    _worker_call = (function, shared)
+
+
+def call_in_worker(*args):
+    """Calls the worker's function with its shared arguments, then args."""
+    function, shared = _worker_call
+    return function(*shared, *args)
+
+
+def worker_map(pool, function, shared, *args):
+    """Maps function(*shared, *args) over argument lists, in a process pool
+    if there is one. The pool must come from start_worker_pool(..., function,
+    *shared), so that only the per-call arguments are sent with each task."""
+    if pool is None:
+        return [function(*shared, *call_args) for call_args in zip(*args)]
+    return list(pool.map(call_in_worker, *args))
+
+
+def forward_sample(bnet, num_samples, seed=None):
+    """Draws samples from the joint distribution of a Bayesian network.
+
+    Parameters
+    ----------
+    bnet : BayesianNetwork
+        The network to sample from.
+    num_samples : int
+        The number of samples to draw.
+    seed : int, optional
+        The seed of the random number generator.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        For each variable name, its value in each sample.
+    """
+
+    network = CompiledNetwork(bnet)
+    codes, _ = weighted_samples(network, {}, num_samples, np.random.default_rng(seed))
+    return {var.get_name(): np.array(var.get_domain(), dtype=object)[codes[:, i]]
+            for i, var in enumerate(network.variables)}
+
+
+def anytime_likelihood_weighting(bnet, evidence, batch_size=1000, num_workers=1, seed=None):
+    """Estimates posterior marginals by likelihood weighting, indefinitely.
+
+    Each round draws batch_size samples in each of num_workers worker
+    processes (in this process if num_workers is 1) and then yields the
+    running SamplingResult, so the caller can stop whenever the estimate is
+    good enough or time runs out.
+    """
+
+    network = CompiledNetwork(bnet)
+    encoded = network.encode_evidence(evidence)
+    result = SamplingResult(network)
+    seeds = np.random.SeedSequence(seed)
+    shared = (network, encoded)
+    pool = start_worker_pool(num_workers, likelihood_weighting_batch, *shared)
+    start = time.perf_counter()
+    try:
+        while True:
+            for batch in worker_map(pool, likelihood_weighting_batch, shared,
+                                    [batch_size] * num_workers, seeds.spawn(num_workers)):
+                result.add(0, *batch)
+            result.elapsed = time.perf_counter() - start
+            yield result
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def anytime_gibbs_sampling(bnet, evidence, num_chains=16, sweeps_per_round=100, burn_in=100,
+                           max_table_size=4096, num_workers=1, seed=None):
+    """Estimates posterior marginals by blocked Gibbs sampling, indefinitely.
+
+    The chains start from distinct states drawn by likelihood weighting (see
+    initial_states), are split among num_workers worker processes, and are
+    run for burn_in sweeps before any sample is recorded. Each round then
+    runs sweeps_per_round sweeps of every chain and yields the running
+    SamplingResult, whose rhat compares the chains.
+    """
+
+    network = CompiledNetwork(bnet)
+    encoded = network.encode_evidence(evidence)
+    blocks = gibbs_blocks(network, encoded, max_table_size)
+    seeds = np.random.SeedSequence(seed)
+    state = initial_states(network, encoded, num_chains, np.random.default_rng(seeds.spawn(1)[0]))
+    groups = [group for group in np.array_split(np.arange(num_chains), num_workers) if len(group) > 0]
+    result = SamplingResult(network, num_chains)
+    shared = (network, blocks)
+    pool = start_worker_pool(len(groups), gibbs_sweeps, *shared)
+    start = time.perf_counter()
+
+    def run(num_sweeps, record):
+        outputs = worker_map(pool, gibbs_sweeps, shared,
+                             [state[group] for group in groups], [num_sweeps] * len(groups),
+                             seeds.spawn(len(groups)), [record] * len(groups))
+        for group, (group_state, counts) in zip(groups, outputs):
+            state[group] = group_state
+            for chain, chain_counts in zip(group, counts):
+                result.add(chain, chain_counts, 0.0, num_sweeps, num_sweeps, num_sweeps)
+
+    try:
+        if burn_in > 0:
+            run(burn_in, False)
+            result.totals[:] = 0.0
+            result.weight_sums[:] = 0.0
+            result.weight_square_sums[:] = 0.0
+            result.num_samples[:] = 0
+        while True:
+            run(sweeps_per_round, True)
+            result.elapsed = time.perf_counter() - start
+            yield result
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def run_until(estimates, num_samples, time_limit=None):
+    """Consumes an anytime estimator until it has num_samples samples or
+    time_limit seconds have passed, and returns its last result."""
+    for result in estimates:
+        if result.num_samples.sum() >= num_samples or (time_limit is not None
+                                                       and result.elapsed >= time_limit):
+            estimates.close()
+            return result
+
+
+def likelihood_weighting(bnet, evidence, num_samples=10000, batch_size=1000, num_workers=1,
+                         seed=None, time_limit=None):
+    """Estimates the posterior marginals of a network by likelihood weighting.
+
+    Parameters
+    ----------
+    bnet : BayesianNetwork
+        The network.
+    evidence : dict[str, str]
+        The observed value of each evidence variable.
+    num_samples : int
+        The number of samples to draw (rounded up to whole rounds).
+    batch_size : int
+        The number of samples drawn at once by each worker.
+    num_workers : int
+        The number of worker processes (1 to sample in this process).
+    seed : int, optional
+        The seed of the random number generators.
+    time_limit : float, optional
+        If given, stop after the first round that ends past this many seconds.
+
+    Returns
+    -------
+    SamplingResult
+        The estimate; see SamplingResult.get_marginals.
+    """
+
+    return run_until(anytime_likelihood_weighting(bnet, evidence, batch_size, num_workers, seed),
+                     num_samples, time_limit)
+
+
+def gibbs_sampling(bnet, evidence, num_samples=4000, num_chains=16, sweeps_per_round=100,
+                   burn_in=100, max_table_size=4096, num_workers=1, seed=None, time_limit=None):
+    """Estimates the posterior marginals of a network by blocked Gibbs sampling.
+
+    Parameters
+    ----------
+    bnet : BayesianNetwork
+        The network.
+    evidence : dict[str, str]
+        The observed value of each evidence variable.
+    num_samples : int
+        The number of recorded sweeps, over all chains (rounded up to whole
+        rounds).
+    num_chains : int
+        The number of independent chains.
+    sweeps_per_round : int
+        The number of sweeps of each chain between two estimates.
+    burn_in : int
+        The number of initial sweeps of each chain that are not recorded.
+    max_table_size : int
+        The largest table (per chain) allowed when eliminating a block of
+        variables that are resampled together; see gibbs_blocks.
+    num_workers : int
+        The number of worker processes (1 to sample in this process).
+    seed : int, optional
+        The seed of the random number generators.
+    time_limit : float, optional
+        If given, stop after the first round that ends past this many seconds.
+
+    Returns
+    -------
+    SamplingResult
+        The estimate; see SamplingResult.get_marginals and SamplingResult.rhat.
+    """
+
+    return run_until(anytime_gibbs_sampling(bnet, evidence, num_chains, sweeps_per_round, burn_in,
+                                            max_table_size, num_workers, seed),
+                     num_samples, time_limit)
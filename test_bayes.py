@@ -44,8 +44,39 @@ class TestBayes(unittest.TestCase):
         self.assertEqual(moral_graph.get_edges(),
                          [('B', 'L'), ('L', 'P'), ('L', 'U'), ('P', 'S')])
 
+    def test_get_value(self):
+        bnet = create_example_net()
+        value = bnet.get_value({'P': 'yes', 'L': 'u', 'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        self.assertAlmostEqual(value, .87 * .1 * .1 * .9 * .9)
+        self.assertAlmostEqual(bnet.get_value({'P': 'yes'}), .87)
+        self.assertAlmostEqual(bnet.get_value({'P': 'yes', 'S': '-ve'}), .087)
+        self.assertAlmostEqual(bnet.to_sparse().get_value({'P': 'yes', 'S': '-ve'}), .087)
+
+    def test_get_value_long_chain(self):
+        chain = [Variable(f'X{i}', ['0', '1']) for i in range(3000)]
+        factors = [Factor([chain[0]], {('0',): .3, ('1',): .7})]
+        for parent, child in zip(chain, chain[1:]):
+            factors.append(Factor([parent, child], {('0', '0'): .9, ('0', '1'): .1,
+                                                    ('1', '0'): .2, ('1', '1'): .8}))
+        bnet = BayesianNetwork(factors)
+        self.assertAlmostEqual(bnet.get_value({'X0': '1'}), .7)
+        self.assertAlmostEqual(bnet.get_value({'X0': '1', 'X1': '0'}), .14)
+        self.assertAlmostEqual(bnet.to_sparse().get_value({'X0': '1', 'X1': '0'}), .14)
 
+    def test_prune_barren(self):
+        bnet = create_example_net()
+        pruned, report = bnet.prune(['P'], {'S': '-ve'})
+        self.assertEqual({v.get_name() for v in pruned.get_variables()}, {'P', 'S'})
+        self.assertEqual(report.barren, {'B', 'U', 'L'})
+        self.assertEqual(report.factors_after, 2)
+        self.assertAlmostEqual(report.fraction_removed(), .6)
 
+    def test_prune_d_separated(self):
+        bnet = create_example_net()
+        pruned, report = bnet.prune(['L'], {'P': 'yes', 'S': '-ve', 'B': '-ve'})
+        self.assertEqual({v.get_name() for v in pruned.get_variables()}, {'P', 'L', 'B'})
+        self.assertEqual(report.barren, {'U'})
+        self.assertEqual(report.disconnected, {'S'})
 
 
 if __name__ == "__main__":
@@ -1,8 +1,13 @@
+import gc
 import unittest
+import weakref
 import pandas as pd
 from factor import Factor, Variable
 from bayes import BayesianNetwork
-from elimination import conditional_prob, min_degree_elim_order
+from bayes import UndirectedGraph
+from elimination import conditional_prob, min_degree_elim_order, QueryEngine
+from elimination import min_fill_elim_order, weighted_min_fill_elim_order, elim_order_stats
+from elimination import map_assignment, query_engine
 
 
 def create_example_net():
@@ -46,6 +51,54 @@ class TestElimination(unittest.TestCase):
         prob = conditional_prob(bnet, {'L': 'u'}, {'S': '-ve', 'B': '-ve', 'U': '-ve'})
         self.assertAlmostEqual(prob, .9585, places=4)
 
+    def test_query_engine(self):
+        bnet = create_example_net()
+        engine = QueryEngine(bnet)
+        evidence = {'S': '-ve', 'B': '-ve', 'U': '-ve'}
+        posterior = engine.posterior(['P', 'L'], evidence)
+        self.assertAlmostEqual(posterior.get_value({'P': 'yes', 'L': 'u'}) +
+                               posterior.get_value({'P': 'yes', 'L': 'd'}), .1021, places=4)
+        self.assertAlmostEqual(posterior.get_value({'P': 'yes', 'L': 'u'}) +
+                               posterior.get_value({'P': 'no', 'L': 'u'}), .9585, places=4)
+        engine.posterior(['P'], {'S': '+ve', 'B': '-ve', 'U': '+ve'})
+        self.assertEqual(len(engine._elim_orders), 1)
+        self.assertIs(query_engine(bnet), query_engine(bnet))
+        networks = [create_example_net() for _ in range(5)]
+        for network in networks:
+            conditional_prob(network, {'P': 'yes'}, evidence)
+        refs = [weakref.ref(network) for network in networks]
+        del network, networks
+        gc.collect()
+        self.assertTrue(all(ref() is None for ref in refs))
+
+    def test_elim_order_heuristics(self):
+        bnet = create_example_net()
+        evidence = {'S': '-ve', 'B': '-ve', 'U': '-ve'}
+        for heuristic in [min_degree_elim_order, min_fill_elim_order,
+                          weighted_min_fill_elim_order]:
+            order = heuristic(bnet.moral_graph(), bnet.domain_sizes())
+            self.assertEqual(sorted(order), ['B', 'L', 'P', 'S', 'U'])
+            prob = conditional_prob(bnet, {'P': 'yes'}, evidence, heuristic)
+            self.assertAlmostEqual(prob, .1021, places=4)
+
+    def test_fill_in_edges(self):
+        cycle = UndirectedGraph(['A', 'B', 'C', 'D'],
+                                [('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'A')])
+        sizes = {'A': 2, 'B': 3, 'C': 2, 'D': 2}
+        order = min_degree_elim_order(cycle, sizes)
+        self.assertEqual(order[0], 'A')
+        self.assertEqual(elim_order_stats(cycle, order, sizes), (2, 12))
+        # Filling in A-C (2 x 2) is cheaper than filling in B-D (3 x 2).
+        order = weighted_min_fill_elim_order(cycle, sizes)
+        self.assertIn(order[0], ['B', 'D'])
+
+    def test_map_assignment(self):
+        bnet = create_example_net()
+        mpe = map_assignment(bnet, ['P', 'L', 'S', 'B', 'U'], {'U': '+ve'})
+        self.assertEqual(mpe, {'P': 'yes', 'L': 'd', 'S': '+ve', 'B': '+ve', 'U': '+ve'})
+        self.assertEqual(map_assignment(bnet, ['P', 'B'], {'U': '+ve'}), {'P': 'yes', 'B': '+ve'})
+        self.assertEqual(map_assignment(bnet, ['L'], {'U': '-ve', 'B': '-ve'}), {'L': 'u'})
+
 
 if __name__ == "__main__":
     unittest.main()   
\ No newline at end of file
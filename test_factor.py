@@ -1,6 +1,8 @@
+import pickle
 import unittest
+import numpy as np
 import pandas as pd
-from factor import Variable, Factor, multiply
+from factor import Variable, Factor, DenseFactor, SparseFactor, FactorTemplate, multiply, multiply_marginalize
 
 
 def example_factors():
@@ -69,6 +71,132 @@ class TestBayes(unittest.TestCase):
         self.assertAlmostEqual(product.get_value({'P': 'no', 'L': 'u'}), .1287)
         self.assertAlmostEqual(product.get_value({'P': 'no', 'L': 'd'}), .0013)
 
+    def test_dense_factor(self):
+        p_factor, l_factor = example_factors()
+        dense = l_factor.to_dense()
+        self.assertIsInstance(dense, DenseFactor)
+        self.assertEqual(dense.get_variables(), l_factor.get_variables())
+        self.assertEqual(dense.get_value({'P': 'no', 'L': 'u'}), .99)
+        self.assertAlmostEqual(dense.normalize().get_value({'P': 'yes', 'L': 'd'}), .45)
+        reduced = dense.reduce({'P': 'yes'})
+        self.assertEqual(reduced.get_value({'P': 'yes', 'L': 'u'}), .1)
+        self.assertEqual(reduced.get_value({'P': 'no', 'L': 'u'}), 0.0)
+        summed = dense.sum_out(Variable('P', ['yes', 'no']))
+        self.assertAlmostEqual(summed.get_value({'L': 'u'}), 1.09)
+        self.assertAlmostEqual(summed.get_value({'L': 'd'}), .91)
+
+    def test_multiply_dense(self):
+        p_factor, l_factor = example_factors()
+        product = multiply([p_factor.to_dense(), l_factor])
+        self.assertIsInstance(product, DenseFactor)
+        self.assertAlmostEqual(product.get_value({'P': 'yes', 'L': 'u'}), .087)
+        self.assertAlmostEqual(product.get_value({'P': 'yes', 'L': 'd'}), .783)
+        self.assertAlmostEqual(product.get_value({'P': 'no', 'L': 'u'}), .1287)
+        self.assertAlmostEqual(product.get_value({'P': 'no', 'L': 'd'}), .0013)
+
+    def test_multiply_marginalize(self):
+        p_factor, l_factor = example_factors()
+        marginal = multiply_marginalize([p_factor, l_factor], ['L'])
+        self.assertEqual([v.get_name() for v in marginal.get_variables()], ['L'])
+        self.assertAlmostEqual(marginal.get_value({'L': 'u'}), .2157)
+        self.assertAlmostEqual(marginal.get_value({'L': 'd'}), .7843)
+        total = multiply_marginalize([p_factor, l_factor], [])
+        self.assertAlmostEqual(total.get_value({}), 1.0)
+
+    def test_log_domain(self):
+        p_factor, l_factor = example_factors()
+        p_log = p_factor.to_dense(log_domain=True)
+        l_log = l_factor.to_dense(log_domain=True)
+        self.assertTrue(p_log.is_log_domain())
+        product = multiply([p_log, l_log])
+        self.assertTrue(product.is_log_domain())
+        self.assertAlmostEqual(product.get_value({'P': 'no', 'L': 'u'}), .1287)
+        marginal = multiply_marginalize([p_log, l_log], ['L'])
+        self.assertAlmostEqual(marginal.get_value({'L': 'u'}), .2157)
+        summed = l_log.sum_out(Variable('P', ['yes', 'no']))
+        self.assertAlmostEqual(summed.get_value({'L': 'u'}), 1.09)
+        reduced = l_log.reduce({'P': 'yes'}).normalize()
+        self.assertAlmostEqual(reduced.get_value({'P': 'yes', 'L': 'd'}), .9)
+        self.assertEqual(reduced.get_value({'P': 'no', 'L': 'd'}), 0.0)
+
+    def test_log_domain_avoids_underflow(self):
+        x = Variable('X', ['a', 'b'])
+        tiny = Factor([x], {('a',): 1e-10, ('b',): 3e-10})
+        factors = [tiny.to_dense(log_domain=True) for _ in range(100)]
+        marginal = multiply_marginalize(factors, ['X']).normalize()
+        self.assertAlmostEqual(marginal.get_value({'X': 'b'}), 3 ** 100 / (1 + 3 ** 100))
+        self.assertAlmostEqual(marginal.get_log_value({'X': 'a'}), -100 * np.log(3), places=6)
+
+    def test_log_domain_cancelling_mass(self):
+        for num_variables, small in [(400, .001), (15, 1e-30)]:
+            factors = []
+            for i in range(num_variables):
+                v = Variable(f'V{i}', ['a', 'b'])
+                factors.append(DenseFactor([v], [1 - small, small]).to_dense(log_domain=True))
+                factors.append(DenseFactor([v], [small, 1 - small]).to_dense(log_domain=True))
+            total = multiply_marginalize(factors, []).get_table()
+            self.assertAlmostEqual(float(total), num_variables * np.log(2 * small * (1 - small)), places=6)
+
+    def test_sparse_factor(self):
+        p = Variable('P', ['yes', 'no'])
+        l = Variable('L', ['u', 'd'])
+        factor = SparseFactor([p, l], {('yes', 'u'): 0.0, ('yes', 'd'): 1.0,
+                                       ('no', 'u'): 0.5, ('no', 'd'): 0.5})
+        self.assertNotIn("('yes', 'u')", str(factor))
+        self.assertEqual(factor.get_value({'P': 'yes', 'L': 'u'}), 0.0)
+        summed = factor.sum_out(p)
+        self.assertIsInstance(summed, SparseFactor)
+        self.assertEqual(summed.get_value({'L': 'u'}), 0.5)
+        self.assertEqual(summed.get_value({'L': 'd'}), 1.5)
+        reduced = factor.reduce({'P': 'no'})
+        self.assertIsInstance(reduced, SparseFactor)
+        self.assertEqual(reduced.get_value({'P': 'yes', 'L': 'd'}), 0.0)
+
+    def test_multiply_sparse(self):
+        p_factor, l_factor = example_factors()
+        product = multiply([p_factor.to_sparse(), l_factor])
+        self.assertIsInstance(product, SparseFactor)
+        self.assertAlmostEqual(product.get_value({'P': 'yes', 'L': 'u'}), .087)
+        self.assertAlmostEqual(product.get_value({'P': 'no', 'L': 'd'}), .0013)
+        marginal = multiply_marginalize([p_factor.to_sparse(), l_factor], ['L'])
+        self.assertIsInstance(marginal, SparseFactor)
+        self.assertAlmostEqual(marginal.get_value({'L': 'u'}), .2157)
+        self.assertAlmostEqual(marginal.get_value({'L': 'd'}), .7843)
+
+    def test_variable_interning(self):
+        p1 = Variable('P', ['yes', 'no'])
+        p2 = Variable('P', ('yes', 'no'))
+        self.assertEqual(p1.get_id(), p2.get_id())
+        self.assertEqual(p1, p2)
+        self.assertEqual(hash(p1), hash(p2))
+        self.assertNotEqual(p1, Variable('P', ['no', 'yes']))
+        self.assertEqual(p1.encode('no'), 1)
+        self.assertEqual(pickle.loads(pickle.dumps(p1)), p1)
+
+    def test_reduce_unknown_value(self):
+        _, l_factor = example_factors()
+        reduced = l_factor.reduce({'P': 'maybe'})
+        with self.assertRaises(KeyError):
+            reduced.get_value({'P': 'yes', 'L': 'u'})
+        self.assertEqual(reduced.to_dense().get_table().sum(), 0.0)
+
+    def test_factor_template(self):
+        template = FactorTemplate([('yes', 'no'), ('u', 'v')], {
+            ('yes', 'u'): 0.9, ('yes', 'v'): 0.1, ('no', 'u'): 0.2, ('no', 'v'): 0.8})
+        first = template.bind([Variable('P1', ['yes', 'no']), Variable('L1', ['u', 'v'])])
+        second = template.bind([Variable('P2', ['yes', 'no']), Variable('L2', ['u', 'v'])])
+        self.assertEqual(first.get_value({'P1': 'no', 'L1': 'v'}), 0.8)
+        self.assertEqual(second.get_value({'P2': 'yes', 'L2': 'v'}), 0.1)
+        self.assertIs(first.to_dense().get_table(), second.to_dense().get_table())
+        self.assertFalse(first.to_dense().get_table().flags.writeable)
+        reduced = first.reduce({'P1': 'yes'})
+        self.assertIs(type(reduced), Factor)
+        self.assertEqual(reduced.get_value({'P1': 'yes', 'L1': 'u'}), 0.9)
+        copy = pickle.loads(pickle.dumps(first))
+        self.assertEqual(copy.get_value({'P1': 'no', 'L1': 'u'}), 0.2)
+        with self.assertRaises(ValueError):
+            template.bind([Variable('P3', ['no', 'yes']), Variable('L3', ['u', 'v'])])
+
 
 if __name__ == "__main__":
     unittest.main()   
\ No newline at end of file
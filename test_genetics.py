@@ -0,0 +1,188 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from genetics import Male, Female
+from genetics import compile_family_junction_tree, pedigree_hash
+from genetics import create_family_bayes_net, PeelingEngine, load_pedigree
+from genetics import InheritanceModel, AUTOSOMAL_DOMINANT, AUTOSOMAL_RECESSIVE, AlleleFrequencySweep
+from junction import build_junction_tree_for_bayes_net
+from junction import BeliefPropagation
+
+
+def create_example_family():
+    grandmother = Female(name="grandmother")
+    grandfather = Male(name="grandfather")
+    mother = Female(name="mother", mother=grandmother, father=grandfather)
+    father = Male(name="father")
+    uncle = Male(name="uncle", mother=grandmother, father=grandfather)
+    son = Male(name="son", mother=mother, father=father)
+    daughter = Female(name="daughter", mother=mother, father=father)
+    return [grandmother, grandfather, mother, father, uncle, son, daughter]
+
+
+class TestGenetics(unittest.TestCase):
+
+    def test_pedigree_hash(self):
+        family = create_example_family()
+        self.assertEqual(pedigree_hash(family), pedigree_hash(create_example_family()))
+        family[-1].father = None
+        self.assertNotEqual(pedigree_hash(family), pedigree_hash(create_example_family()))
+
+    def test_compile_family_junction_tree_cache(self):
+        family = create_example_family()
+        evidence = {'P_uncle': '+'}
+        with tempfile.TemporaryDirectory() as tmp:
+            compiled = compile_family_junction_tree(family, cache_dir=tmp)
+            self.assertEqual(os.listdir(tmp), [f'{pedigree_hash(family)}.npz'])
+            cached = compile_family_junction_tree(family, cache_dir=tmp)
+        for jtree in [compiled, cached]:
+            templates = {id(factor.get_template()) for factors in jtree.factors.values()
+                         for factor in factors}
+            self.assertEqual(len(templates), 7)
+        for jtree in [compiled, cached]:
+            bp = BeliefPropagation(jtree)
+            bp.run(evidence)
+            marginals = bp.get_marginals()
+            self.assertAlmostEqual(marginals['G_grandmother'].get_value({'G_grandmother': 'xX'}),
+                                   1.0, places=2)
+            self.assertAlmostEqual(marginals['G_son'].get_value({'G_son': 'Xy'}), .25, places=2)
+
+    def test_inheritance_models(self):
+        family = create_example_family()
+        self.assertNotEqual(pedigree_hash(family, AUTOSOMAL_RECESSIVE), pedigree_hash(family))
+        bp = BeliefPropagation(build_junction_tree_for_bayes_net(
+            create_family_bayes_net(family, AUTOSOMAL_RECESSIVE)))
+        bp.run({'G_mother': 'aA', 'G_father': 'aA'})
+        marginals = bp.get_marginals(['G_son'])
+        self.assertAlmostEqual(marginals['G_son'].get_value({'G_son': 'AA'}), .25)
+        bp = BeliefPropagation(build_junction_tree_for_bayes_net(
+            create_family_bayes_net(family, AUTOSOMAL_DOMINANT)))
+        bp.run({'P_uncle': '+', 'P_grandmother': '-'})
+        marginals = bp.get_marginals(['G_grandfather'])
+        self.assertAlmostEqual(marginals['G_grandfather'].get_value({'G_grandfather': 'aa'}), 0.0)
+
+        model = InheritanceModel(['A1', 'A2', 'A3'], dominant=True, mutation_rate=0.01, penetrance=0.8)
+        self.assertEqual(model.transmission['female'].shape, (6, 3))
+        np.testing.assert_allclose(model.transmission['female'].sum(axis=1), 1.0)
+        bp = BeliefPropagation(build_junction_tree_for_bayes_net(create_family_bayes_net(family, model)))
+        bp.run({'G_mother': 'A1/A1', 'G_father': 'A1/A1'})
+        marginals = bp.get_marginals(['G_son', 'P_son'])
+        self.assertAlmostEqual(marginals['G_son'].get_value({'G_son': 'A1/A2'}), 2 * .99 * .005)
+        self.assertAlmostEqual(marginals['P_son'].get_value({'P_son': '+'}), .8 * (1 - .99 ** 2))
+
+    def test_allele_frequency_sweep(self):
+        family = create_example_family()
+        evidence = {'P_uncle': '+', 'P_son': '-'}
+        grid = np.array([0.001, 0.01, 0.2])
+        posteriors = AlleleFrequencySweep(family).run(grid, evidence)
+        self.assertEqual(posteriors['G_daughter'].shape, (3, 3))
+        for point, frequency in enumerate(grid):
+            model = InheritanceModel(['x', 'X'], frequencies=[1 - frequency, frequency], x_linked=True)
+            bp = BeliefPropagation(build_junction_tree_for_bayes_net(create_family_bayes_net(family, model)))
+            bp.run(evidence)
+            for name, expected in bp.get_marginals(list(posteriors)).items():
+                np.testing.assert_allclose(posteriors[name][point], expected.to_dense().get_table())
+        with self.assertRaises(ValueError):
+            AlleleFrequencySweep(family, InheritanceModel(['A1', 'A2', 'A3'])).run(grid)
+
+    def test_peeling_engine(self):
+        family = create_example_family()
+        evidence = {'P_uncle': '+', 'P_son': '-', 'P_daughter': '-'}
+        peeling = PeelingEngine(family)
+        peeling.run(evidence)
+        marginals = peeling.get_marginals()
+        bp = BeliefPropagation(build_junction_tree_for_bayes_net(create_family_bayes_net(family)))
+        bp.run(evidence)
+        expected = bp.get_marginals()
+        for member in family:
+            name = f'G_{member.get_name()}'
+            for value in expected[name].get_variable(name).get_domain():
+                self.assertAlmostEqual(marginals[name].get_value({name: value}),
+                                       expected[name].get_value({name: value}))
+        peeling.run({'P_uncle': '+'})
+        self.assertAlmostEqual(peeling.log_likelihood, np.log(.001))
+        family.append(Female(name="half_sister", mother=family[2]))
+        models = [AUTOSOMAL_DOMINANT, InheritanceModel(['A1', 'A2', 'A3'], x_linked=True, penetrance=.9,
+                                                       phenocopy=.05, mutation_rate=.01)]
+        for model in models:
+            peeling = PeelingEngine(family, model=model)
+            peeling.run(evidence)
+            bp = BeliefPropagation(build_junction_tree_for_bayes_net(create_family_bayes_net(family, model)))
+            bp.run(evidence)
+            for name, expected in bp.get_marginals(list(peeling.get_marginals())).items():
+                np.testing.assert_allclose(peeling.get_marginals()[name].get_table(),
+                                           expected.to_dense().get_table())
+        self.assertRaises(ValueError, PeelingEngine, family, .01, models[1])
+
+    def test_peeling_engine_loop(self):
+        family = create_example_family()
+        sister = Female(name="sister", mother=family[2], father=family[3])
+        family += [sister, Male(name="child", mother=sister, father=family[5])]
+        self.assertRaises(ValueError, PeelingEngine, family)
+
+    def test_load_pedigree(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ped = os.path.join(tmp, 'family.ped')
+            with open(ped, 'w') as f:
+                f.write('# family id father mother sex phenotype\n'
+                        'F1 son father mother 1 2\n'
+                        'F1 mother 0 0 2 1\n'
+                        'F1 father 0 0 1 0\n'
+                        'F1 daughter father mother 2 0\n')
+            family, evidence, report = load_pedigree(ped, chunk_size=2)
+            self.assertTrue(report.is_clean())
+            self.assertEqual([member.get_name() for member in family],
+                             ['F1_son', 'F1_mother', 'F1_father', 'F1_daughter'])
+            self.assertIs(family[0].mother, family[1])
+            self.assertIs(family[3].father, family[2])
+            self.assertEqual(evidence, {'P_F1_son': '+', 'P_F1_mother': '-'})
+            with open(ped, 'w') as f:
+                f.write('F1 1 0 0 1 0\n'
+                        'F1 2 0 0 2 0\n'
+                        'F1 3 1 2 1 2\n'
+                        'F2 1 0 0 1 0\n'
+                        'F2 2 0 0 0 0\n'
+                        'F2 3 1 2 2 1\n')
+            family, evidence, report = load_pedigree(ped)
+            self.assertEqual([member.get_name() for member in family],
+                             ['F1_1', 'F1_2', 'F1_3', 'F2_1', 'F2_3'])
+            self.assertIs(family[2].father, family[0])
+            self.assertIs(family[2].mother, family[1])
+            self.assertIs(family[4].father, family[3])
+            self.assertIsNone(family[4].mother)
+            self.assertEqual(report.unknown_sex, ['F2_2'])
+            self.assertEqual(report.orphans, [('F2_3', 'F2_2')])
+            self.assertEqual(evidence, {'P_F1_3': '+', 'P_F2_3': '-'})
+            self.assertRaises(ValueError, load_pedigree, ped, strict=True)
+            csv_path = os.path.join(tmp, 'family.csv')
+            with open(csv_path, 'w') as f:
+                f.write('id,sex,mother,father\n'
+                        'a,F,b,,\n'
+                        'b,F,a,,\n'
+                        'c,M,a,ghost\n'
+                        'd,M,c,\n'
+                        'a,M,,\n')
+            family, evidence, report = load_pedigree(csv_path)
+            self.assertEqual(len(family), 4)
+            self.assertEqual(report.duplicates, ['a'])
+            self.assertEqual(report.orphans, [('c', 'ghost')])
+            self.assertEqual(report.sex_conflicts, [('d', 'c')])
+            self.assertEqual(len(report.cycles), 1)
+            self.assertEqual(len(create_family_bayes_net(family).get_factors()), 14)
+            self.assertRaises(ValueError, load_pedigree, csv_path, strict=True)
+            with open(csv_path, 'w') as f:
+                f.write('id,sex,mother,father\n'
+                        'a,F,,\n'
+                        'b,M,a\n')
+            with self.assertRaisesRegex(ValueError, 'family.csv, line 3'):
+                load_pedigree(csv_path)
+            with open(ped, 'w') as f:
+                f.write('F1 1 0 0 1 0\n'
+                        'F1 2 0\n')
+            with self.assertRaisesRegex(ValueError, 'family.ped, line 2'):
+                load_pedigree(ped)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,13 @@
+import os
+import tempfile
 import unittest
 import pandas as pd
 from factor import Variable, Factor
-from bayes import BayesianNetwork
-from junction import build_junction_tree_for_bayes_net, BeliefPropagation
+from bayes import BayesianNetwork, UndirectedGraph
+from junction import build_junction_tree_for_bayes_net, BeliefPropagation, make_propagation
+from junction import JunctionTree, ParallelBeliefPropagation, build_junction_tree
+from junction import save_junction_tree, load_junction_tree, BatchBeliefPropagation
+from junction import MaxProductPropagation
 
 
 def create_example_net():
@@ -50,6 +55,222 @@ class TestJunction(unittest.TestCase):
         prob = marginals['L'].get_value({'L': 'u'})
         self.assertAlmostEqual(prob, .9585, places=4)
 
+    def test_selected_marginals(self):
+        jtree = build_junction_tree_for_bayes_net(create_example_net())
+        for architecture in ['shafer-shenoy', 'hugin']:
+            bp = make_propagation(jtree, architecture)
+            bp.run({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+            marginals = bp.get_marginals(['L', 'Q'])
+            self.assertEqual(list(marginals), ['L'])
+            self.assertAlmostEqual(marginals['L'].get_value({'L': 'u'}), .9585, places=4)
+
+    def test_belief_propagation_dense(self):
+        bnet = create_example_net().to_dense()
+        jtree = build_junction_tree_for_bayes_net(bnet)
+        bp = BeliefPropagation(jtree)
+        bp.run({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        marginals = bp.get_marginals()
+        prob = marginals['P'].get_value({'P': 'yes'})
+        self.assertAlmostEqual(prob, .1021, places=4)
+        prob = marginals['L'].get_value({'L': 'u'})
+        self.assertAlmostEqual(prob, .9585, places=4)
+
+    def test_belief_propagation_sparse(self):
+        bnet = create_example_net().to_sparse()
+        jtree = build_junction_tree_for_bayes_net(bnet)
+        bp = BeliefPropagation(jtree)
+        bp.run({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        marginals = bp.get_marginals()
+        prob = marginals['P'].get_value({'P': 'yes'})
+        self.assertAlmostEqual(prob, .1021, places=4)
+        prob = marginals['L'].get_value({'L': 'u'})
+        self.assertAlmostEqual(prob, .9585, places=4)
+
+    def test_belief_propagation_pruned(self):
+        bnet = create_example_net()
+        evidence = {'S': '-ve', 'B': '-ve'}
+        jtree = build_junction_tree_for_bayes_net(bnet, query_vars=['L'], evidence=evidence)
+        self.assertNotIn('U', jtree.node_map)
+        bp = BeliefPropagation(jtree)
+        bp.run(evidence)
+        full = BeliefPropagation(build_junction_tree_for_bayes_net(bnet))
+        full.run(evidence)
+        self.assertAlmostEqual(bp.get_marginals()['L'].get_value({'L': 'u'}),
+                               full.get_marginals()['L'].get_value({'L': 'u'}))
+
+    def test_incremental_update(self):
+        bnet = create_example_net()
+        jtree = build_junction_tree_for_bayes_net(bnet)
+        bp = BeliefPropagation(jtree)
+        bp.run({'S': '-ve'})
+        total = len(bp.messages)
+        recomputed = bp.update({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        self.assertLess(recomputed, total)
+        marginals = bp.get_marginals()
+        self.assertAlmostEqual(marginals['P'].get_value({'P': 'yes'}), .1021, places=4)
+        self.assertAlmostEqual(marginals['L'].get_value({'L': 'u'}), .9585, places=4)
+        bp.update({'S': '-ve'})
+        fresh = BeliefPropagation(jtree)
+        fresh.run({'S': '-ve'})
+        for var, marginal in fresh.get_marginals().items():
+            for value in marginal.get_variable(var).get_domain():
+                self.assertAlmostEqual(bp.get_marginals()[var].get_value({var: value}),
+                                       marginal.get_value({var: value}))
+        self.assertEqual(bp.update({'S': '-ve'}), 0)
+
+    def test_hugin_propagation(self):
+        for bnet in [create_example_net(), create_example_net().to_dense(log_domain=True)]:
+            jtree = build_junction_tree_for_bayes_net(bnet)
+            hugin = make_propagation(jtree, 'hugin')
+            hugin.run({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+            marginals = hugin.get_marginals()
+            prob = marginals['P'].get_value({'P': 'yes'})
+            self.assertAlmostEqual(prob, .1021, places=4)
+            prob = marginals['L'].get_value({'L': 'u'})
+            self.assertAlmostEqual(prob, .9585, places=4)
+
+    def test_message_schedule(self):
+        graph = UndirectedGraph(list(range(6)), [(0, 1), (1, 2), (2, 3), (3, 4), (5, 3)])
+        clusters = [{'A'}, {'A', 'B'}, {'B', 'C'}, {'C', 'D'}, {'D', 'E'}, {'D', 'F'}]
+        jtree = JunctionTree(graph, clusters)
+        jtree.add_variables([Variable(name, ['0', '1']) for name in 'ABCDEF'])
+        schedule = jtree.init_message_queue()
+        self.assertEqual(len(schedule), 10)
+        self.assertEqual(set(schedule), {(a, b) for a in range(6) for b in graph.get_neighbors(a)})
+        collect = schedule[:5]
+        self.assertEqual({dest for (_, dest) in collect} - {src for (src, _) in collect}, {2})
+        self.assertIs(jtree.init_message_queue(), schedule)
+        centroid_collect = jtree.init_message_queue('centroid')[:5]
+        self.assertEqual({d for (_, d) in centroid_collect} - {s for (s, _) in centroid_collect}, {3})
+
+    def test_belief_propagation_forest(self):
+        x = Variable('X', ['0', '1'])
+        y = Variable('Y', ['0', '1'])
+        z = Variable('Z', ['0', '1'])
+        factors = create_example_net().get_factors() + [
+            Factor([x], {('0',): .3, ('1',): .7}),
+            Factor([x, y], {('0', '0'): .9, ('0', '1'): .1, ('1', '0'): .2, ('1', '1'): .8}),
+            Factor([z], {('0',): .5, ('1',): .5})]
+        jtree = build_junction_tree_for_bayes_net(BayesianNetwork(factors))
+        for architecture in ['shafer-shenoy', 'hugin']:
+            bp = make_propagation(jtree, architecture)
+            bp.run({'S': '-ve', 'B': '-ve', 'U': '-ve', 'Y': '1'})
+            marginals = bp.get_marginals()
+            self.assertAlmostEqual(marginals['P'].get_value({'P': 'yes'}), .1021, places=4)
+            self.assertAlmostEqual(marginals['X'].get_value({'X': '1'}), .56 / .59)
+            self.assertAlmostEqual(marginals['Z'].get_value({'Z': '1'}), .5)
+
+    def test_parallel_belief_propagation(self):
+        bnet = create_example_net()
+        jtree = build_junction_tree_for_bayes_net(bnet)
+        bp = ParallelBeliefPropagation(jtree, max_workers=4)
+        bp.run({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        self.assertEqual(set(bp.messages), set(jtree.init_message_queue()))
+        marginals = bp.get_marginals()
+        self.assertAlmostEqual(marginals['P'].get_value({'P': 'yes'}), .1021, places=4)
+        self.assertAlmostEqual(marginals['L'].get_value({'L': 'u'}), .9585, places=4)
+
+    def test_parallel_belief_propagation_parts(self):
+        factors = []
+        for component, length in [('A', 40), ('B', 3), ('C', 1)]:
+            chain = [Variable(f'{component}{i}', ['0', '1']) for i in range(length)]
+            factors.append(Factor([chain[0]], {('0',): .3, ('1',): .7}))
+            for parent, child in zip(chain, chain[1:]):
+                factors.append(Factor([parent, child], {('0', '0'): .9, ('0', '1'): .1,
+                                                        ('1', '0'): .2, ('1', '1'): .8}))
+        jtree = build_junction_tree_for_bayes_net(BayesianNetwork(factors))
+        evidence = {'A39': '0', 'B2': '1'}
+        bp = ParallelBeliefPropagation(jtree, max_workers=2, parts_per_worker=3)
+        part, _ = bp.split(6)
+        self.assertEqual(set(part), set(jtree.graph.nodes))
+        self.assertGreater(len(set(part.values())), 3)
+        bp.run(evidence)
+        self.assertEqual(set(bp.messages), set(jtree.init_message_queue()))
+        serial = BeliefPropagation(jtree)
+        serial.run(evidence)
+        expected = serial.get_marginals()
+        for name, marginal in bp.get_marginals().items():
+            for value in ['0', '1']:
+                self.assertAlmostEqual(marginal.get_value({name: value}),
+                                       expected[name].get_value({name: value}))
+
+    def test_build_junction_tree(self):
+        bnet = create_example_net()
+        jtree = build_junction_tree_for_bayes_net(bnet)
+        self.assertEqual(sorted(sorted(c) for c in jtree.clusters),
+                         [['B', 'L'], ['L', 'P'], ['L', 'U'], ['P', 'S']])
+        self.assertEqual(len(jtree.graph.get_edges()), 3)
+        nodes = [str(i) for i in range(3000)]
+        chain = UndirectedGraph(nodes, list(zip(nodes, nodes[1:])))
+        jtree = build_junction_tree(chain, nodes)
+        self.assertEqual(len(jtree.clusters), 2999)
+        self.assertEqual(len(jtree.graph.get_edges()), 2998)
+
+    def test_batch_belief_propagation(self):
+        jtree = build_junction_tree_for_bayes_net(create_example_net())
+        cases = [{'S': '-ve', 'B': '-ve', 'U': '-ve'}, {}, {'P': 'no', 'U': '+ve'}, {'S': 'maybe'}]
+        batch = BatchBeliefPropagation(jtree)
+        batch.run(cases)
+        marginals = batch.get_marginals()
+        self.assertEqual(marginals['P'].shape, (4, 2))
+        self.assertAlmostEqual(marginals['P'][0, 0], .1021, places=4)
+        self.assertAlmostEqual(marginals['L'][0, 0], .9585, places=4)
+        self.assertAlmostEqual(marginals['P'][1, 0], .87, places=4)
+        self.assertEqual(list(marginals['S'][3]), [0.0, 0.0])
+        bp = BeliefPropagation(jtree)
+        bp.run(cases[2])
+        expected = bp.get_marginals()['B'].get_value({'B': '+ve'})
+        self.assertAlmostEqual(batch.get_case_marginals(2)['B'].get_value({'B': '+ve'}), expected)
+        batch.run(cases[2:3])
+        case_marginals = batch.get_case_marginals(0, ['B'])
+        self.assertEqual(list(case_marginals), ['B'])
+        self.assertAlmostEqual(case_marginals['B'].get_value({'B': '+ve'}), expected)
+
+    def test_max_product_propagation(self):
+        for bnet in [create_example_net(), create_example_net().to_dense(log_domain=True)]:
+            jtree = build_junction_tree_for_bayes_net(bnet)
+            mp = MaxProductPropagation(jtree)
+            mp.run({'U': '+ve'})
+            self.assertEqual(mp.get_mpe(),
+                             {'P': 'yes', 'L': 'd', 'S': '+ve', 'B': '+ve', 'U': '+ve'})
+            max_marginals = mp.get_marginals()
+            self.assertAlmostEqual(max_marginals['B'].get_value({'B': '-ve'}), .3)
+            self.assertAlmostEqual(max_marginals['U'].get_value({'U': '-ve'}), 0.0)
+
+    def test_add_factor(self):
+        a, b, c = Variable('A', [0, 1]), Variable('B', [0, 1]), Variable('C', [0, 1, 2])
+        jtree = JunctionTree(UndirectedGraph([0, 1], [(0, 1)]), [{'A', 'B', 'C'}, {'A', 'B'}])
+        jtree.add_factor(Factor([a, b, c], {(i, j, k): 1 / 3 for i in [0, 1]
+                                            for j in [0, 1] for k in [0, 1, 2]}))
+        jtree.add_factor(Factor([a], {(0,): .4, (1,): .6}))
+        jtree.add_factor(Factor([a, b], {(0, 0): .5, (0, 1): .5, (1, 0): .1, (1, 1): .9}))
+        self.assertEqual([len(jtree.factors[0]), len(jtree.factors[1])], [1, 2])
+        potential = jtree.get_potential(1)
+        self.assertAlmostEqual(potential.get_value({'A': 1, 'B': 1}), .54)
+        self.assertEqual(len(jtree._potentials), 1)
+        jtree = JunctionTree(UndirectedGraph([0, 1], [(0, 1)]), [{'A', 'C'}, {'A', 'B'}])
+        jtree.add_variables([a, b, c])
+        jtree.add_factor(Factor([a], {(0,): .4, (1,): .6}))
+        self.assertEqual([len(jtree.factors[0]), len(jtree.factors[1])], [0, 1])
+
+    def test_save_and_load(self):
+        bnet = BayesianNetwork(create_example_net().get_factors()[:3] +
+                               [f.to_sparse() for f in create_example_net().get_factors()[3:]])
+        jtree = build_junction_tree_for_bayes_net(bnet)
+        with tempfile.TemporaryDirectory() as tmp:
+            save_junction_tree(jtree, os.path.join(tmp, 'jtree.npz'))
+            loaded = load_junction_tree(os.path.join(tmp, 'jtree.npz'))
+        self.assertEqual(loaded.clusters, [set(c) for c in jtree.clusters])
+        self.assertEqual(loaded.graph.get_edges(), jtree.graph.get_edges())
+        self.assertEqual(loaded.init_message_queue(), jtree.init_message_queue())
+        self.assertEqual([len(loaded.factors[n]) for n in loaded.graph.nodes],
+                         [len(jtree.factors[n]) for n in jtree.graph.nodes])
+        bp = BeliefPropagation(loaded)
+        bp.run({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        marginals = bp.get_marginals()
+        self.assertAlmostEqual(marginals['P'].get_value({'P': 'yes'}), .1021, places=4)
+        self.assertAlmostEqual(marginals['L'].get_value({'L': 'u'}), .9585, places=4)
+
 
 if __name__ == "__main__":
     unittest.main()   
\ No newline at end of file
@@ -0,0 +1,116 @@
+import unittest
+import numpy as np
+from factor import Variable, Factor
+from bayes import BayesianNetwork
+from genetics import create_family_bayes_net
+from junction import build_junction_tree_for_bayes_net, BeliefPropagation
+from sampling import forward_sample, likelihood_weighting, gibbs_sampling
+from sampling import anytime_likelihood_weighting, gibbs_blocks, CompiledNetwork, initial_states
+from test_genetics import create_example_family
+
+
+def create_example_net():
+    p = Variable('P', ['yes', 'no'])
+    l = Variable('L', ['u', 'd'])
+    s = Variable('S', ['-ve', '+ve'])
+    b = Variable('B', ['-ve', '+ve'])
+    u = Variable('U', ['-ve', '+ve'])
+    p_factor = Factor([p], {
+        ('yes',): 0.87,
+        ('no',): 0.13})
+    l_factor = Factor([p, l], {
+        ('yes', 'u'): 0.1,
+        ('yes', 'd'): 0.9,
+        ('no', 'u'): 0.99,
+        ('no', 'd'): 0.01})
+    s_factor = Factor([p, s], {
+        ('yes', '-ve'): 0.1,
+        ('yes', '+ve'): 0.9,
+        ('no', '-ve'): 0.99,
+        ('no', '+ve'): 0.01})
+    b_factor = Factor([l, b], {
+        ('u', '-ve'): 0.9,
+        ('u', '+ve'): 0.1,
+        ('d', '-ve'): 0.3,
+        ('d', '+ve'): 0.7})
+    u_factor = Factor([l, u], {
+        ('u', '-ve'): 0.9,
+        ('u', '+ve'): 0.1,
+        ('d', '-ve'): 0.2,
+        ('d', '+ve'): 0.8})
+    return BayesianNetwork([p_factor, l_factor, s_factor, b_factor, u_factor])
+
+
+class TestSampling(unittest.TestCase):
+
+    def test_forward_sample(self):
+        samples = forward_sample(create_example_net(), 20000, seed=0)
+        self.assertAlmostEqual((samples['P'] == 'yes').mean(), .87, delta=.01)
+        self.assertAlmostEqual((samples['L'] == 'u').mean(), .2157, delta=.01)
+
+    def test_likelihood_weighting(self):
+        evidence = {'S': '-ve', 'B': '-ve', 'U': '-ve'}
+        result = likelihood_weighting(create_example_net(), evidence, 20000, seed=0)
+        marginals = result.get_marginals()
+        self.assertAlmostEqual(marginals['P'].get_value({'P': 'yes'}), .1021, delta=.01)
+        self.assertAlmostEqual(marginals['L'].get_value({'L': 'u'}), .9585, delta=.01)
+        self.assertEqual(marginals['S'].get_value({'S': '-ve'}), 1.0)
+        self.assertGreater(result.effective_sample_size(), 1000)
+        parallel = likelihood_weighting(create_example_net(), evidence, 20000, num_workers=2, seed=0)
+        self.assertAlmostEqual(parallel.get_marginals()['P'].get_value({'P': 'yes'}),
+                               marginals['P'].get_value({'P': 'yes'}))
+
+    def test_anytime_likelihood_weighting(self):
+        estimates = anytime_likelihood_weighting(create_example_net(), {'U': '+ve'}, batch_size=100)
+        counts = [next(estimates).num_samples.sum() for _ in range(3)]
+        estimates.close()
+        self.assertEqual(counts, [100, 200, 300])
+
+    def test_gibbs_sampling(self):
+        evidence = {'S': '-ve', 'B': '-ve', 'U': '-ve'}
+        result = gibbs_sampling(create_example_net(), evidence, 4000, num_chains=4, seed=0)
+        marginals = result.get_marginals()
+        self.assertAlmostEqual(marginals['P'].get_value({'P': 'yes'}), .1021, delta=.02)
+        self.assertAlmostEqual(marginals['L'].get_value({'L': 'u'}), .9585, delta=.02)
+        self.assertLess(max(result.rhat().values()), 1.1)
+
+    def test_gibbs_sampling_pedigree(self):
+        bnet = create_family_bayes_net(create_example_family())
+        evidence = {'P_uncle': '+', 'P_son': '-'}
+        bp = BeliefPropagation(build_junction_tree_for_bayes_net(bnet))
+        bp.run(evidence)
+        exact = bp.get_marginals()
+        marginals = gibbs_sampling(bnet, evidence, 1500, num_chains=4, seed=0).get_marginals()
+        for name in ['G_mother', 'G_daughter']:
+            for value in exact[name].get_variable(name).get_domain():
+                self.assertAlmostEqual(marginals[name].get_value({name: value}),
+                                       exact[name].get_value({name: value}), delta=.05)
+
+    def test_initial_states(self):
+        network = CompiledNetwork(create_example_net())
+        evidence = network.encode_evidence({'S': '-ve'})
+        states = initial_states(network, evidence, 8, np.random.default_rng(0))
+        self.assertEqual(len(np.unique(states, axis=0)), 8)
+        evidence = network.encode_evidence({'S': '-ve', 'B': '-ve', 'U': '-ve'})
+        with self.assertWarns(UserWarning):
+            states = initial_states(network, evidence, 8, np.random.default_rng(0))
+        self.assertEqual(len(np.unique(states, axis=0)), 4)
+
+    def test_gibbs_blocks(self):
+        network = CompiledNetwork(create_family_bayes_net(create_example_family()))
+        evidence = network.encode_evidence({'P_uncle': '+'})
+        blocks = gibbs_blocks(network, evidence, 8)
+        self.assertGreater(len(blocks), 1)
+        blocked = [{position for position, _, _ in steps} for _, steps in blocks]
+        self.assertEqual(set.union(*blocked), set(range(len(network.variables))) - set(evidence))
+        self.assertEqual(len(gibbs_blocks(network, evidence, 4096)), 1)
+
+    def test_cycle(self):
+        a, b = Variable('A', [0, 1]), Variable('B', [0, 1])
+        bnet = BayesianNetwork([Factor([a, b], {(0, 0): 1.0, (1, 1): 1.0}),
+                                Factor([b, a], {(0, 0): 1.0, (1, 1): 1.0})])
+        self.assertRaises(ValueError, CompiledNetwork, bnet)
+
+
+if __name__ == "__main__":
+    unittest.main()